@@ -0,0 +1,301 @@
+# Simulator benchmarks
+# Times proj1 disassembly and the proj2 run loops on generated RISC-V..
+# ..programs and writes the figures to a JSON file for comparing versions
+
+import argparse # for parsing the command line arguments
+import contextlib # for silencing the baseline's console output
+import importlib.util # for loading the riscv-sim.py scripts
+import io
+import json # for the results file
+import os
+import platform
+import struct # for packing the generated programs into binaries
+import subprocess # for tagging results with the git commit
+import sys
+import tempfile # for the binaries proj1 maps in
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+########## HELPER FUNCTIONS ##########
+def load_simulator(project):
+    # riscv-sim.py isn't a valid module name, so load it by path
+    path = os.path.join(ROOT, project, "riscv-sim.py")
+    spec = importlib.util.spec_from_file_location(f"{project}_sim", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def git_output(args):
+    result = subprocess.run(["git"] + args, cwd=ROOT, capture_output=True, check=True)
+    return result.stdout
+
+def load_baseline_simulator(revision=None):
+    # The original proj2, read out of git at revision so the if/elif execute..
+    # ..loop can be timed next to the current modes. Without a revision it's..
+    # ..the repository's first commit, which no rebase or squash renames
+    try:
+        if revision is None:
+            revision = git_output(["rev-list", "--max-parents=0", "HEAD"]).decode().split()[-1]
+        source = git_output(["show", f"{revision}:proj2/riscv-sim.py"])
+    except OSError as e:
+        sys.exit(f"can't run git to read the proj2 baseline: {e}")
+    except subprocess.CalledProcessError as e:
+        sys.exit(f"can't read proj2/riscv-sim.py at baseline {revision or 'root commit'}: "
+                 f"{e.stderr.decode().strip()} (pick another one with --baseline REV)")
+    spec = importlib.util.spec_from_loader("proj2_baseline", loader=None)
+    module = importlib.util.module_from_spec(spec)
+    exec(compile(source, f"{revision}:proj2/riscv-sim.py", "exec"), module.__dict__)
+    return module
+
+def encode_r(funct7, rs2, rs1, funct3, rd, opcode=0b0110011):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_i(imm, rs1, funct3, rd, opcode=0b0010011):
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_s(imm, rs2, rs1, funct3=0b010):
+    imm &= 0xFFF
+    return ((imm >> 5) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | ((imm & 0b11111) << 7) | 0b0100011
+
+def encode_u(imm, rd, opcode=0b0110111):
+    return ((imm & 0xFFFFF) << 12) | (rd << 7) | opcode
+
+def encode_b(offset, rs2, rs1, funct3):
+    imm = offset & 0x1FFF
+    return (((imm >> 12) & 0b1) << 31) | (((imm >> 5) & 0b111111) << 25) | (rs2 << 20) | (rs1 << 15) \
+        | (funct3 << 12) | (((imm >> 1) & 0b1111) << 8) | (((imm >> 11) & 0b1) << 7) | 0b1100011
+
+def encode_j(offset, rd=0):
+    imm = offset & 0x1FFFFF
+    return (((imm >> 20) & 0b1) << 31) | (((imm >> 1) & 0x3FF) << 21) | (((imm >> 11) & 0b1) << 20) \
+        | (((imm >> 12) & 0xFF) << 12) | (rd << 7) | 0b1101111
+
+def pack_program(program):
+    return struct.pack(f"<{len(program)}I", *program)
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+########## HELPER FUNCTIONS ##########
+
+########## WORKLOADS ##########
+# Every workload loops for at least as many steps as it is given, so a run..
+# ..always retires exactly the requested number of instructions
+def alu_loop(iterations):
+    # Counter loop with a body of dependent R-type ALU ops
+    body = [
+        encode_r(0b0000000, 1, 2, 0b000, 2),  # add x2, x2, x1
+        encode_r(0b0000000, 2, 3, 0b100, 3),  # xor x3, x3, x2
+        encode_r(0b0100000, 3, 4, 0b000, 4),  # sub x4, x4, x3
+        encode_r(0b0000000, 3, 2, 0b111, 6),  # and x6, x2, x3
+        encode_r(0b0000000, 4, 6, 0b110, 7),  # or x7, x6, x4
+        encode_r(0b0000000, 1, 7, 0b101, 8),  # srl x8, x7, x1
+        encode_r(0b0000000, 2, 8, 0b010, 9),  # slt x9, x8, x2
+    ]
+    program = [encode_u(iterations >> 12, 5), encode_i(iterations & 0xFFF, 5, 0b110, 5), encode_i(0, 0, 0b000, 1)]
+    program += body
+    program.append(encode_i(1, 1, 0b000, 1))  # addi x1, x1, 1
+    program.append(encode_b(-4 * (len(body) + 1), 5, 1, 0b001))  # bne x1, x5, loop
+    return program
+
+def memory_stream(iterations, pages=4):
+    # Walks a few pages of data memory, loading, bumping and storing each word
+    program = [
+        encode_u(0x10000, 10),                 # outer: lui x10, 0x10000
+        encode_u(0x10000 + pages, 12),         # lui x12, 0x10000 + pages
+        encode_i(0, 10, 0b010, 11, 0b0000011), # inner: lw x11, 0(x10)
+        encode_i(1, 11, 0b000, 11),            # addi x11, x11, 1
+        encode_s(0, 11, 10),                   # sw x11, 0(x10)
+        encode_i(4, 10, 0b000, 10),            # addi x10, x10, 4
+        encode_b(-16, 12, 10, 0b001),          # bne x10, x12, inner
+    ]
+    program.append(encode_j(-4 * len(program)))  # jal x0, outer
+    return program
+
+def branch_heavy(iterations):
+    # Branches on the low bits of a counter, so each one has its own..
+    # ..taken/not-taken pattern
+    program = [encode_i(0, 0, 0b000, 1)]  # addi x1, x0, 0
+    loop = len(program)
+    for bit in range(6):
+        program.append(encode_i(1 << bit, 1, 0b111, 3))  # andi x3, x1, 1 << bit
+        program.append(encode_b(8, 0, 3, 0b000))          # beq x3, x0, +8
+        program.append(encode_i(1, 4, 0b000, 4))          # addi x4, x4, 1
+    program.append(encode_i(1, 1, 0b000, 1))  # addi x1, x1, 1
+    program.append(encode_j(-4 * (len(program) - loop)))  # jal x0, loop
+    return program
+
+def mmio_print(iterations, text="hello, world\n"):
+    # Prints a line through the console register over and over
+    program = [encode_u(0x20000, 7)]  # lui x7, 0x20000
+    loop = len(program)
+    for char in text:
+        program.append(encode_i(ord(char), 0, 0b000, 8))  # addi x8, x0, char
+        program.append(encode_s(0, 8, 7))                 # sw x8, 0(x7)
+    program.append(encode_j(-4 * (len(program) - loop)))  # jal x0, loop
+    return program
+
+WORKLOADS = {
+    "alu_loop": alu_loop,
+    "memory_stream": memory_stream,
+    "branch_heavy": branch_heavy,
+    "mmio_print": mmio_print,
+}
+########## WORKLOADS ##########
+
+########## BENCHMARKS ##########
+def bench_baseline(baseline, instructions, num_instructions):
+    # The original run loop from the baseline revision: if/elif decode of..
+    # ..every step, a defaultdict data memory and print() for the console
+    instructions = list(instructions)
+    registers = [0x00000000] * 32
+    data_memory = baseline.defaultdict(lambda: 0xFF)
+    execute_instruction = baseline.execute_instruction
+    program_end = len(instructions) * 4
+    pc = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(num_instructions):
+            if pc >= program_end:
+                break
+            pc = execute_instruction(instructions[pc // 4], pc, registers, data_memory)
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+def bench_table_step_decode(sim, instructions, num_instructions):
+    # Decode every step through the current dispatch table, no pre-decoding
+    registers = sim.make_registers()
+    data_memory = sim.DataMemory(sim.Console(io.StringIO()))
+    execute_instruction = sim.execute_instruction
+    program_end = len(instructions) * 4
+    pc = 0
+    start = time.perf_counter()
+    for _ in range(num_instructions):
+        if pc >= program_end:
+            break
+        pc = execute_instruction(instructions[pc // 4], pc, registers, data_memory)
+    return time.perf_counter() - start
+
+def bench_table_dispatch(sim, instructions, num_instructions):
+    # Pre-decode through the dispatch table, then run the records
+    machine = sim.Machine(instructions, console=sim.Console(io.StringIO()))
+    start = time.perf_counter()
+    machine.run(num_instructions)
+    return time.perf_counter() - start
+
+def bench_translated(sim, instructions, num_instructions):
+    # Compile basic blocks into Python functions and run those
+    machine = sim.Machine(instructions, console=sim.Console(io.StringIO()))
+    start = time.perf_counter()
+    machine.run(num_instructions, translate=True)
+    return time.perf_counter() - start
+
+PROJ2_MODES = {
+    "table step decode": bench_table_step_decode,
+    "table dispatch": bench_table_dispatch,
+    "translated": bench_translated,
+}
+
+def bench_listing(sim, file_name, batch):
+    # One listing of the whole binary, as the scalar cached or NumPy path
+    start = time.perf_counter()
+    sim.listing_chunk(file_name, 0, len(sim.load_instructions(file_name)), batch, sim.DISASSEMBLY_CACHE_SIZE)
+    return time.perf_counter() - start
+
+def best_of(repeat, bench, *args):
+    return min(bench(*args) for _ in range(repeat))
+
+def run_proj2(workloads, num_instructions, repeat, baseline_revision=None):
+    sim = load_simulator("proj2")
+    modes = [("baseline", load_baseline_simulator(baseline_revision), bench_baseline)]
+    modes += [(mode, sim, bench) for mode, bench in PROJ2_MODES.items()]
+    results = []
+    for workload in workloads:
+        instructions = sim.get_instructions(pack_program(WORKLOADS[workload](num_instructions)))
+        for mode, module, bench in modes:
+            elapsed = best_of(repeat, bench, module, instructions, num_instructions)
+            results.append({
+                "project": "proj2", "workload": workload, "mode": mode,
+                "instructions": num_instructions, "seconds": elapsed,
+                "instructions_per_sec": num_instructions / elapsed,
+            })
+            print(f"proj2 {workload:>13} {mode:>17}: {num_instructions / elapsed:12,.0f} instructions/sec ({elapsed:.3f}s)")
+    return results
+
+def run_proj1(workloads, num_words, repeat):
+    # proj1 maps its input, so each workload is tiled out to num_words and..
+    # ..written to a temporary binary
+    sim = load_simulator("proj1")
+    modes = {"cached": False}
+    if sim.np is not None:
+        modes["batch"] = True
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workload in workloads:
+            program = WORKLOADS[workload](num_words)
+            contents = pack_program((program * (num_words // len(program) + 1))[:num_words])
+            file_name = os.path.join(directory, f"{workload}.bin")
+            with open(file_name, "wb") as f:
+                f.write(contents)
+            for mode, batch in modes.items():
+                elapsed = best_of(repeat, bench_listing, sim, file_name, batch)
+                results.append({
+                    "project": "proj1", "workload": workload, "mode": mode,
+                    "bytes": len(contents), "seconds": elapsed,
+                    "bytes_per_sec": len(contents) / elapsed,
+                })
+                print(f"proj1 {workload:>13} {mode:>17}: {len(contents) / elapsed:12,.0f} bytes/sec ({elapsed:.3f}s)")
+    return results
+########## BENCHMARKS ##########
+
+########## MAIN PROGRAM ##########
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark proj1 disassembly and proj2 execution")
+    parser.add_argument("num_instructions", nargs="?", type=int, default=1000000,
+                        help="steps each proj2 run retires")
+    parser.add_argument("--words", type=int, default=1 << 18,
+                        help="instruction words in each proj1 binary")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="only run this workload (repeatable)")
+    parser.add_argument("--project", choices=("proj1", "proj2"),
+                        help="only benchmark one of the projects")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="run each benchmark N times and keep the fastest")
+    parser.add_argument("--output", default="bench-results.json",
+                        help="JSON file the results are written to")
+    parser.add_argument("--baseline", metavar="REV",
+                        help="git commit, tag or branch whose proj2 the baseline mode runs (default: the "
+                             "repository's first commit)")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    workloads = args.workload or list(WORKLOADS)
+
+    results = []
+    if args.project in (None, "proj2"):
+        results += run_proj2(workloads, args.num_instructions, args.repeat, args.baseline)
+    if args.project in (None, "proj1"):
+        results += run_proj1(workloads, args.words, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+        }, f, indent=2)
+        f.write("\n")
+
+if __name__ == "__main__":
+    main()
+########## MAIN PROGRAM ##########
@@ -1,7 +1,25 @@
 # Proj1
 # Rio Pramana - 2023318129
 
-import sys # for receiving the command line argument
+import argparse # for parsing the command line arguments
+import functools # for the disassembly cache
+import hashlib # for naming listing cache entries
+import json # for --cfg-json
+import mmap # for mapping large binaries instead of reading them in
+import os
+import struct # for the listing cache header
+import sys
+from array import array # for byte-swapping words on big-endian hosts
+from collections import deque # for the window of in-flight --jobs chunks
+from concurrent.futures import ProcessPoolExecutor # for --jobs
+
+try:
+    import numpy as np # optional, only needed by --batch
+except ImportError:
+    np = None
+
+DISASSEMBLY_CACHE_SIZE = 4096
+JOB_CHUNK_WORDS = 1 << 18
 
 ########## HELPER FUNCTIONS ##########
 def read_file(file_name):
@@ -9,12 +27,50 @@ def read_file(file_name):
         file_contents = f.read()
     return file_contents
 
+def map_file(file_name):
+    # Memory-map the file read-only (empty files can't be mapped)
+    with open(file_name, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""
+
+class InstructionStream:
+    # Zero-copy view of a binary as little-endian 32-bit instruction words
+    def __init__(self, file_contents):
+        view = memoryview(file_contents)
+        whole = len(view) - len(view) % 4
+        if sys.byteorder == "little":
+            self.words = view[:whole].cast("I")
+        else:
+            self.words = array("I", view[:whole])
+            self.words.byteswap()
+        self.num_words = whole // 4
+        # A trailing partial word is read as if zero padded
+        self.tail = int.from_bytes(view[whole:], byteorder = "little") if whole < len(view) else None
+
+    def __len__(self):
+        return self.num_words + (self.tail is not None)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if 0 <= i < self.num_words:
+            return self.words[i]
+        if i == self.num_words and self.tail is not None:
+            return self.tail
+        raise IndexError("instruction index out of range")
+
+    def __iter__(self):
+        yield from self.words
+        if self.tail is not None:
+            yield self.tail
+
 def get_instructions(file_contents):
-    instructions = []
-    for i in range(0, len(file_contents), 4):
-        instruction = int.from_bytes(file_contents[i:i + 4], byteorder = "little")
-        instructions.append(instruction)
-    return instructions
+    return InstructionStream(file_contents)
+
+def load_instructions(file_name):
+    return InstructionStream(map_file(file_name))
 
 def twos_complement(val, bits):
     return (1 << bits) + val if val < 0 else val
@@ -176,19 +232,757 @@ def disassemble_instruction(inst):
             return f"and x{rd}, x{rs1}, x{rs2}"
     else:
         return "unknown instruction"
+
+def make_disassembly_cache(size=DISASSEMBLY_CACHE_SIZE):
+    # Bounded LRU cache in front of disassemble_instruction(), keyed by the..
+    # ..instruction word since the same encodings repeat a lot in real binaries
+    return functools.lru_cache(maxsize=size)(disassemble_instruction)
+
+def report_disassembly_cache(cached_disassemble, file=sys.stderr):
+    info = cached_disassemble.cache_info()
+    lookups = info.hits + info.misses
+    hit_rate = info.hits / lookups if lookups else 0.0
+    print(f"disassembly cache: {info.hits} hits, {info.misses} misses, {hit_rate:.1%} hit rate, "
+          f"{info.currsize}/{info.maxsize} entries", file=file)
 ########## MAIN FUNCTIONS ##########
 
+########## BATCH DISASSEMBLY ##########
+# Field and immediate extraction for a whole chunk of words at once with NumPy,
+# leaving only the string formatting of each distinct word to Python
+BATCH_CHUNK_WORDS = 1 << 20
+
+def format_u(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, {imm}"
+
+def format_mem_rd(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, {imm}(x{rs1})"
+
+def format_mem_rs2(name, rd, rs1, rs2, imm):
+    return f"{name} x{rs2}, {imm}(x{rs1})"
+
+def format_b(name, rd, rs1, rs2, imm):
+    return f"{name} x{rs1}, x{rs2}, {imm}"
+
+def format_i(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, x{rs1}, {imm}"
+
+def format_r(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, x{rs1}, x{rs2}"
+
+# (opcode, funct3, funct7) -> (mnemonic, immediate kind, formatter)
+# None in a key means the field is not part of the encoding
+INSTRUCTION_TABLE = {
+    (0b0110111, None, None): ("lui", "u", format_u),
+    (0b0010111, None, None): ("auipc", "u_unsigned", format_u),
+    (0b1101111, None, None): ("jal", "j", format_u),
+    (0b1100111, 0b000, None): ("jalr", "i_unsigned", format_mem_rd),
+
+    (0b1100011, 0b000, None): ("beq", "b", format_b),
+    (0b1100011, 0b001, None): ("bne", "b", format_b),
+    (0b1100011, 0b100, None): ("blt", "b", format_b),
+    (0b1100011, 0b101, None): ("bge", "b", format_b),
+    (0b1100011, 0b110, None): ("bltu", "b", format_b),
+    (0b1100011, 0b111, None): ("bgeu", "b", format_b),
+
+    (0b0000011, 0b000, None): ("lb", "i", format_mem_rd),
+    (0b0000011, 0b001, None): ("lh", "i", format_mem_rd),
+    (0b0000011, 0b010, None): ("lw", "i", format_mem_rd),
+    (0b0000011, 0b100, None): ("lbu", "i", format_mem_rd),
+    (0b0000011, 0b101, None): ("lhu", "i", format_mem_rd),
+
+    (0b0100011, 0b000, None): ("sb", "s", format_mem_rs2),
+    (0b0100011, 0b001, None): ("sh", "s", format_mem_rs2),
+    (0b0100011, 0b010, None): ("sw", "s", format_mem_rs2),
+
+    (0b0010011, 0b000, None): ("addi", "i", format_i),
+    (0b0010011, 0b010, None): ("slti", "i", format_i),
+    (0b0010011, 0b011, None): ("sltiu", "i", format_i),
+    (0b0010011, 0b100, None): ("xori", "i", format_i),
+    (0b0010011, 0b110, None): ("ori", "i", format_i),
+    (0b0010011, 0b111, None): ("andi", "i", format_i),
+    (0b0010011, 0b001, None): ("slli", "shamt", format_i),
+    (0b0010011, 0b101, 0b0000000): ("srli", "shamt", format_i),
+    (0b0010011, 0b101, 0b0100000): ("srai", "shamt", format_i),
+
+    (0b0110011, 0b000, 0b0000000): ("add", "none", format_r),
+    (0b0110011, 0b000, 0b0100000): ("sub", "none", format_r),
+    (0b0110011, 0b001, 0b0000000): ("sll", "none", format_r),
+    (0b0110011, 0b010, 0b0000000): ("slt", "none", format_r),
+    (0b0110011, 0b011, 0b0000000): ("sltu", "none", format_r),
+    (0b0110011, 0b100, 0b0000000): ("xor", "none", format_r),
+    (0b0110011, 0b101, 0b0000000): ("srl", "none", format_r),
+    (0b0110011, 0b101, 0b0100000): ("sra", "none", format_r),
+    (0b0110011, 0b110, 0b0000000): ("or", "none", format_r),
+    (0b0110011, 0b111, 0b0000000): ("and", "none", format_r),
+}
+
+def build_batch_tables():
+    # Entry 0 is "unknown instruction", entry 1 the None that disassemble_instruction()..
+    # ..returns for an unlisted funct3/funct7 of a known opcode
+    entries = [None, None] + list(INSTRUCTION_TABLE.values())
+    lookup = np.zeros((128, 8, 128), dtype=np.uint8)
+    for opcode in {key[0] for key in INSTRUCTION_TABLE}:
+        lookup[opcode] = 1
+    # Fill the wildcard keys first so the exact ones win
+    keys = sorted(INSTRUCTION_TABLE, key=lambda key: (key[1] is not None, key[2] is not None))
+    for key in keys:
+        index = entries.index(INSTRUCTION_TABLE[key])
+        opcode, funct3, funct7 = key
+        if funct3 is None:
+            lookup[opcode] = index
+        elif funct7 is None:
+            lookup[opcode, funct3] = index
+        else:
+            lookup[opcode, funct3, funct7] = index
+    return entries, lookup
+
+def batch_immediates(words):
+    # Every immediate format as an int64 array, mirroring disassemble_instruction()
+    w = words.astype(np.int64)
+    imm_i = (((w >> 20) & 0xFFF) ^ 0x800) - 0x800
+    imm_s = (((((w >> 25) & 0b1111111) << 5) | ((w >> 7) & 0b11111)) ^ 0x800) - 0x800
+    imm_b = (((w >> 31) & 0b1) << 12) | (((w >> 7) & 0b1) << 11) | (((w >> 25) & 0b111111) << 5) | (((w >> 8) & 0b1111) << 1)
+    # Same sign_extend(.., 12) / offset / twos_complement steps as the scalar path
+    imm_b = (imm_b & 0x7FF) - (imm_b & 0x800)
+    imm_b = np.where(imm_b & 0x800, imm_b - (1 << 12), imm_b)
+    imm_b = np.where(imm_b < 0, imm_b + (1 << 12), imm_b)
+    imm_j = (((w >> 31) & 0b1) << 20) | (((w >> 12) & 0b11111111) << 12) | (((w >> 20) & 0b1) << 11) | (((w >> 21) & 0b1111111111) << 1)
+    imm_j = (imm_j ^ (1 << 20)) - (1 << 20)
+    return {
+        "none": np.zeros_like(w),
+        "i": imm_i,
+        "i_unsigned": w >> 20,
+        "shamt": (w >> 20) & 0x1F,
+        "s": imm_s,
+        "b": imm_b,
+        "u": ((((w >> 12) & 0xFFFFF) ^ 0x80000) - 0x80000) << 12,
+        "u_unsigned": (w >> 12) << 12,
+        "j": imm_j,
+    }
+
+def disassemble_batch(words, tables):
+    # words is a NumPy uint32 array, returns the disassembly text of each word
+    entries, lookup = tables
+    opcode = words & 0b1111111
+    funct3 = (words >> 12) & 0b111
+    funct7 = (words >> 25) & 0b1111111
+    kinds = lookup[opcode, funct3, funct7]
+
+    immediates = batch_immediates(words)
+    imm = np.zeros(len(words), dtype=np.int64)
+    for index in np.unique(kinds):
+        entry = entries[index]
+        if entry is not None:
+            mask = kinds == index
+            imm[mask] = immediates[entry[1]][mask]
+
+    imm = imm.tolist()
+    rd = ((words >> 7) & 0b11111).tolist()
+    rs1 = ((words >> 15) & 0b11111).tolist()
+    rs2 = ((words >> 20) & 0b11111).tolist()
+    texts = []
+    for i, index in enumerate(kinds.tolist()):
+        if index == 0:
+            texts.append("unknown instruction")
+        elif index == 1:
+            texts.append(None)
+        else:
+            name, imm_kind, format_inst = entries[index]
+            texts.append(format_inst(name, rd[i], rs1[i], rs2[i], imm[i]))
+    return texts
+
+def load_batch_words(file_name):
+    # Whole binary as a NumPy uint32 array, a trailing partial word is zero padded
+    contents = map_file(file_name)
+    whole = len(contents) - len(contents) % 4
+    words = np.frombuffer(contents, dtype="<u4", count=whole // 4)
+    if whole < len(contents):
+        tail = int.from_bytes(contents[whole:], byteorder = "little")
+        words = np.append(words, np.uint32(tail))
+    return words
+
+def batch_listing(words, start, tables):
+    # Listing lines for words[start:] in the same format main() prints. Each..
+    # ..distinct word is disassembled and formatted once, then spread back..
+    # ..out to its positions by index, only the "inst N:" prefix is per word
+    unique, inverse = np.unique(words, return_inverse=True)
+    texts = disassemble_batch(unique, tables)
+    lines = np.array([f"{instruction:08x} {text}\n" for instruction, text in zip(unique.tolist(), texts)], dtype=object)
+    return "".join(map("inst {}: {}".format, range(start, start + len(words)), lines[inverse.ravel()].tolist()))
+
+def print_batch(file_name):
+    tables = build_batch_tables()
+    words = load_batch_words(file_name)
+    for start in range(0, len(words), BATCH_CHUNK_WORDS):
+        sys.stdout.write(batch_listing(words[start:start + BATCH_CHUNK_WORDS], start, tables))
+########## BATCH DISASSEMBLY ##########
+
+########## PARALLEL DISASSEMBLY ##########
+# Each worker maps the binary itself and returns the listing text of one..
+# ..chunk, the parent writes the chunks back out in order
+def listing_chunk(file_name, start, end, batch, cache_size):
+    if batch:
+        words = load_batch_words(file_name)[start:end]
+        return batch_listing(words, start, build_batch_tables()), (0, 0)
+    instructions = load_instructions(file_name)
+    disassemble = make_disassembly_cache(cache_size)
+    lines = []
+    for i in range(start, end):
+        instruction = instructions[i]
+        lines.append(f"inst {i}: {instruction:08x} {disassemble(instruction)}\n")
+    info = disassemble.cache_info()
+    return "".join(lines), (info.hits, info.misses)
+
+def listing_chunks(file_name, num_words, jobs, batch, cache_size):
+    # Yields (text, (hits, misses)) for each chunk of the listing in order,..
+    # ..in this process when jobs is 1 and across a worker pool otherwise
+    if jobs <= 1:
+        for start in range(0, num_words, JOB_CHUNK_WORDS):
+            yield listing_chunk(file_name, start, min(start + JOB_CHUNK_WORDS, num_words), batch, cache_size)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Keep a bounded window of chunks in flight so a huge image..
+        # ..doesn't pile up finished text in memory
+        pending = deque()
+        for start in range(0, num_words, JOB_CHUNK_WORDS):
+            end = min(start + JOB_CHUNK_WORDS, num_words)
+            pending.append(executor.submit(listing_chunk, file_name, start, end, batch, cache_size))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def report_chunk_cache(hits, misses, jobs):
+    lookups = hits + misses
+    hit_rate = hits / lookups if lookups else 0.0
+    workers = f" across {jobs} workers" if jobs > 1 else ""
+    print(f"disassembly cache: {hits} hits, {misses} misses, {hit_rate:.1%} hit rate{workers}", file=sys.stderr)
+
+def print_parallel(file_name, jobs, batch, cache_size, cache_stats):
+    num_words = len(load_instructions(file_name))
+    hits = misses = 0
+    for text, (chunk_hits, chunk_misses) in listing_chunks(file_name, num_words, jobs, batch, cache_size):
+        sys.stdout.write(text)
+        hits, misses = hits + chunk_hits, misses + chunk_misses
+
+    if cache_stats and not batch:
+        report_chunk_cache(hits, misses, jobs)
+########## PARALLEL DISASSEMBLY ##########
+
+########## LISTING CACHE ##########
+# Finished listings saved to disk, one file per binary named after a hash..
+# ..of the binary and of this script, so any change to the disassembler..
+# ..starts a fresh set of entries. Layout (little-endian):
+#   magic, number of words (u64), text length (u64), then the listing text
+# A warm run maps the file and writes the text straight out. Hits are..
+# ..touched, and the least recently used files are deleted once the..
+# ..directory grows past its size limit
+LISTING_CACHE_MAGIC = b"RVLST001"
+LISTING_CACHE_HEADER = struct.Struct("<8sQQ")
+LISTING_CACHE_SUFFIX = ".rvlst"
+LISTING_CACHE_SIZE = 64 << 20
+
+@functools.lru_cache(maxsize=None)
+def tool_version():
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def listing_cache_path(directory, contents):
+    key = hashlib.sha256(tool_version())
+    key.update(contents)
+    return os.path.join(directory, key.hexdigest() + LISTING_CACHE_SUFFIX)
+
+def read_listing_cache(path, num_words):
+    # The mapped file, or None if there's no usable entry
+    try:
+        table = map_file(path)
+    except OSError:
+        return None
+    if len(table) < LISTING_CACHE_HEADER.size:
+        return None
+    magic, words, text_length = LISTING_CACHE_HEADER.unpack_from(table)
+    if magic != LISTING_CACHE_MAGIC or words != num_words or len(table) != LISTING_CACHE_HEADER.size + text_length:
+        return None
+    return table
+
+def open_listing_cache(path):
+    # Write under a temporary name so a concurrent run never maps half a..
+    # ..file, the header is filled in by finish_listing_cache
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    f = open(temp_path, "wb")
+    f.write(bytes(LISTING_CACHE_HEADER.size))
+    return f
+
+def finish_listing_cache(f, path, num_words):
+    text_length = f.tell() - LISTING_CACHE_HEADER.size
+    f.seek(0)
+    f.write(LISTING_CACHE_HEADER.pack(LISTING_CACHE_MAGIC, num_words, text_length))
+    f.close()
+    os.replace(f.name, path)
+
+def discard_listing_cache(f):
+    f.close()
+    try:
+        os.unlink(f.name)
+    except OSError:
+        pass
+
+def evict_listing_cache(directory, limit):
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.name.endswith(LISTING_CACHE_SUFFIX):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+
+def print_cached_listing(file_name, cache_directory, limit, jobs, batch, cache_size, cache_stats):
+    contents = map_file(file_name)
+    num_words = len(get_instructions(contents))
+    path = listing_cache_path(cache_directory, contents)
+    table = read_listing_cache(path, num_words)
+    if table is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        sys.stdout.flush()
+        sys.stdout.buffer.write(memoryview(table)[LISTING_CACHE_HEADER.size:])
+        if cache_stats:
+            print(f"listing cache: hit, {num_words} words from {path}", file=sys.stderr)
+        return
+
+    # Cold run: stream the listing chunk by chunk, to stdout and to the..
+    # ..new cache file at the same time
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        cache_file = open_listing_cache(path)
+    except OSError as e:
+        # The cache is only an optimisation, the listing still gets printed
+        print(f"listing cache: {e}", file=sys.stderr)
+        cache_file = None
+    hits = misses = 0
+    saved = False
+    try:
+        for text, (chunk_hits, chunk_misses) in listing_chunks(file_name, num_words, jobs, batch, cache_size):
+            sys.stdout.write(text)
+            hits, misses = hits + chunk_hits, misses + chunk_misses
+            if cache_file is not None:
+                try:
+                    cache_file.write(text.encode())
+                except OSError as e:
+                    print(f"listing cache: {e}", file=sys.stderr)
+                    discard_listing_cache(cache_file)
+                    cache_file = None
+        if cache_file is not None:
+            try:
+                finish_listing_cache(cache_file, path, num_words)
+                saved = True
+            except OSError as e:
+                print(f"listing cache: {e}", file=sys.stderr)
+                discard_listing_cache(cache_file)
+            cache_file = None
+    finally:
+        if cache_file is not None:
+            discard_listing_cache(cache_file)
+    if saved:
+        try:
+            evict_listing_cache(cache_directory, limit)
+        except OSError as e:
+            print(f"listing cache: {e}", file=sys.stderr)
+
+    if cache_stats:
+        saved_to = f", saved {num_words} words to {path}" if saved else ""
+        print(f"listing cache: miss{saved_to}", file=sys.stderr)
+        if not batch:
+            report_chunk_cache(hits, misses, jobs)
+########## LISTING CACHE ##########
+
+########## CONTROL-FLOW ANALYSIS ##########
+# Splits the binary into basic blocks and links them by their branches and..
+# ..jumps. One pass finds the leaders in a bytearray, blocks and edges are..
+# ..flat lists indexed by block id. Loops come from the dominator tree, an..
+# ..edge is a back-edge only when its target dominates its source, and the..
+# ..JSON gives each block the header of its innermost loop rather than..
+# ..listing every loop body in full. Offsets here are the real signed ISA..
+# ..offsets, unlike the flat listing above which keeps its original output
+CFG_BRANCH = "branch"
+CFG_JUMP = "jump"
+CFG_CALL = "call"
+CFG_RETURN = "return"
+CFG_INDIRECT = "indirect"
+CFG_BRANCH_NAMES = {0b000: "beq", 0b001: "bne", 0b100: "blt", 0b101: "bge", 0b110: "bltu", 0b111: "bgeu"}
+
+def branch_offset(inst):
+    imm = (((inst >> 31) & 0b1) << 12) | (((inst >> 7) & 0b1) << 11) | (((inst >> 25) & 0b111111) << 5) | (((inst >> 8) & 0b1111) << 1)
+    return sign_extend(imm, 13)
+
+def jal_offset(inst):
+    imm = (((inst >> 31) & 0b1) << 20) | (((inst >> 12) & 0b11111111) << 12) | (((inst >> 20) & 0b1) << 11) | (((inst >> 21) & 0b1111111111) << 1)
+    return sign_extend(imm, 21)
+
+def control_flow(inst):
+    # (kind, offset) for an instruction that ends a basic block, else None
+    opcode = inst & 0b1111111
+    if opcode == 0b1100011:
+        if (inst >> 12) & 0b111 in CFG_BRANCH_NAMES:
+            return CFG_BRANCH, branch_offset(inst)
+    elif opcode == 0b1101111:
+        return (CFG_CALL if (inst >> 7) & 0b11111 else CFG_JUMP), jal_offset(inst)
+    elif opcode == 0b1100111 and (inst >> 12) & 0b111 == 0:
+        rd = (inst >> 7) & 0b11111
+        rs1 = (inst >> 15) & 0b11111
+        if rd == 0 and rs1 in (1, 5):
+            return CFG_RETURN, None
+        return CFG_INDIRECT, None
+    return None
+
+class ControlFlowGraph:
+    def __init__(self, instructions):
+        num_words = len(instructions)
+        self.instructions = instructions
+        self.num_words = num_words
+        # Terminators by instruction index: (kind, target index or None)
+        self.terminators = {}
+        self.call_targets = set()
+        self.external_targets = set()
+        leaders = bytearray(num_words + 1)
+        if num_words:
+            leaders[0] = 1
+        for i, inst in enumerate(instructions):
+            flow = control_flow(inst)
+            if flow is None:
+                continue
+            kind, offset = flow
+            target = None
+            if offset is not None:
+                if offset % 4 == 0 and 0 <= i + offset // 4 < num_words:
+                    target = i + offset // 4
+                    leaders[target] = 1
+                    if kind == CFG_CALL:
+                        self.call_targets.add(target)
+                else:
+                    self.external_targets.add(i * 4 + offset)
+            self.terminators[i] = (kind, target)
+            leaders[i + 1] = 1
+
+        # Blocks are [start, end) ranges, block_at maps a leader to its id
+        self.starts = [i for i in range(num_words) if leaders[i]]
+        self.ends = self.starts[1:] + [num_words]
+        self.block_at = {start: block for block, start in enumerate(self.starts)}
+        self.successors = [[] for _ in self.starts]
+        self.predecessors = [[] for _ in self.starts]
+        for block, end in enumerate(self.ends):
+            last = end - 1
+            kind, target = self.terminators.get(last, (None, None))
+            # (successor block, edge kind) pairs
+            edges = []
+            if target is not None and kind in (CFG_BRANCH, CFG_JUMP):
+                edges.append((self.block_at[target], "taken" if kind == CFG_BRANCH else "jump"))
+            if kind in (None, CFG_BRANCH, CFG_CALL) or (kind == CFG_INDIRECT and (self.instructions[last] >> 7) & 0b11111):
+                # Calls come back to the next instruction
+                if end < num_words:
+                    edges.append((block + 1, "fallthrough" if kind is None or kind == CFG_BRANCH else "return"))
+            for successor, edge_kind in edges:
+                self.successors[block].append((successor, edge_kind))
+                self.predecessors[successor].append(block)
+        self.find_dominators()
+        self.find_loops()
+
+    def find_dominators(self):
+        # Cooper, Harvey and Kennedy's iterative algorithm over reverse..
+        # ..postorder. A virtual root (id num_blocks) leads to the entry, the..
+        # ..call targets and any block neither of those reaches
+        num_blocks = len(self.starts)
+        root = num_blocks
+        roots = [0] + sorted(self.block_at[target] for target in self.call_targets) + list(range(num_blocks))
+        postorder = []
+        visited = bytearray(num_blocks)
+        is_root = bytearray(num_blocks)
+        for start in roots:
+            if start >= num_blocks or visited[start]:
+                continue
+            visited[start] = 1
+            is_root[start] = 1
+            stack = [(start, 0)]
+            while stack:
+                block, next_edge = stack[-1]
+                successors = self.successors[block]
+                if next_edge == len(successors):
+                    postorder.append(block)
+                    stack.pop()
+                    continue
+                stack[-1] = (block, next_edge + 1)
+                successor = successors[next_edge][0]
+                if not visited[successor]:
+                    visited[successor] = 1
+                    stack.append((successor, 0))
+        order = [0] * (num_blocks + 1)
+        for number, block in enumerate(postorder):
+            order[block] = number
+        order[root] = num_blocks
+
+        idom = [-1] * (num_blocks + 1)
+        idom[root] = root
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(postorder):
+                new_idom = root if is_root[block] else -1
+                for predecessor in self.predecessors[block]:
+                    if idom[predecessor] == -1:
+                        continue
+                    if new_idom == -1:
+                        new_idom = predecessor
+                        continue
+                    # Walk both fingers up the tree to their common dominator
+                    finger = predecessor
+                    while finger != new_idom:
+                        while order[finger] < order[new_idom]:
+                            finger = idom[finger]
+                        while order[new_idom] < order[finger]:
+                            new_idom = idom[new_idom]
+                if idom[block] != new_idom:
+                    idom[block] = new_idom
+                    changed = True
+        self.idom = [None if dominator == root else dominator for dominator in idom[:num_blocks]]
+
+        # Pre/post numbers on the dominator tree: a dominates b exactly when..
+        # ..b's interval nests inside a's
+        children = [[] for _ in range(num_blocks + 1)]
+        for block in reversed(postorder):
+            children[idom[block]].append(block)
+        self.dom_pre = [0] * (num_blocks + 1)
+        self.dom_post = [0] * (num_blocks + 1)
+        clock = 0
+        stack = [(root, 0)]
+        self.dom_pre[root] = clock
+        while stack:
+            block, next_child = stack[-1]
+            if next_child == len(children[block]):
+                clock += 1
+                self.dom_post[block] = clock
+                stack.pop()
+                continue
+            stack[-1] = (block, next_child + 1)
+            child = children[block][next_child]
+            clock += 1
+            self.dom_pre[child] = clock
+            stack.append((child, 0))
+
+        # A back-edge is an edge whose target dominates its source
+        self.back_edges = [(block, successor) for block, successors in enumerate(self.successors)
+                           for successor, _ in successors if self.dominates(successor, block)]
+
+    def dominates(self, a, b):
+        return self.dom_pre[a] <= self.dom_pre[b] and self.dom_post[b] <= self.dom_post[a]
+
+    def find_loops(self):
+        # Natural loop of each header: the header plus every block that..
+        # ..reaches one of its latches without going through the header.
+        # Headers go innermost first (deepest in the dominator tree), each..
+        # ..finished loop is collapsed into its header through a union-find,..
+        # ..so every block is walked once by its innermost loop only
+        latches = {}
+        for latch, header in self.back_edges:
+            latches.setdefault(header, []).append(latch)
+        num_blocks = len(self.starts)
+        collapsed = list(range(num_blocks))
+
+        def find(block):
+            top = block
+            while collapsed[top] != top:
+                top = collapsed[top]
+            while collapsed[block] != top:
+                collapsed[block], block = top, collapsed[block]
+            return top
+
+        # Innermost loop header of each block, None outside every loop
+        self.loop_of = [None] * num_blocks
+        self.loops = {}
+        for header in sorted(latches, key=lambda header: self.dom_pre[header], reverse=True):
+            self.loop_of[header] = header
+            body = []
+            seen = {header}
+            work = [find(latch) for latch in latches[header]]
+            while work:
+                block = work.pop()
+                if block in seen:
+                    continue
+                seen.add(block)
+                body.append(block)
+                if block in self.loops:
+                    # An inner loop, already collapsed into its header
+                    self.loops[block] = (self.loops[block][0], header)
+                else:
+                    self.loop_of[block] = header
+                for predecessor in self.predecessors[block]:
+                    work.append(find(predecessor))
+            for block in body:
+                collapsed[block] = header
+            self.loops[header] = (sorted(latches[header]), None)
+        self.loops = dict(sorted(self.loops.items()))
+
+    def label(self, block):
+        start = self.starts[block]
+        if start == 0:
+            return "entry"
+        if start in self.call_targets:
+            return f"func_{start}"
+        return f"L{start}"
+
+    def target_label(self, target):
+        return self.label(self.block_at[target])
+
+    def edge_count(self):
+        return sum(len(successors) for successors in self.successors)
+
+    def summary(self):
+        return (f"cfg: {self.num_words} instructions, {len(self.starts)} blocks, {self.edge_count()} edges, "
+                f"{len(self.call_targets)} call targets, {len(self.back_edges)} back-edges, {len(self.loops)} loops")
+
+    def listing(self, file=sys.stdout, cache_size=DISASSEMBLY_CACHE_SIZE):
+        # Labelled listing, control flow shows the signed offset and the target label
+        disassemble = make_disassembly_cache(cache_size)
+        lines = []
+        for block, (start, end) in enumerate(zip(self.starts, self.ends)):
+            notes = []
+            if block in self.loops:
+                latches = ", ".join(self.label(latch) for latch in self.loops[block][0])
+                notes.append(f"loop header, back-edge from {latches}")
+            preds = self.predecessors[block]
+            if preds:
+                notes.append("from " + ", ".join(self.label(pred) for pred in preds))
+            lines.append(f"{self.label(block)}:" + (f"  # {'; '.join(notes)}" if notes else "") + "\n")
+            for i in range(start, end):
+                inst = self.instructions[i]
+                text = disassemble(inst)
+                terminator = self.terminators.get(i)
+                if terminator is not None:
+                    kind, target = terminator
+                    if kind == CFG_BRANCH:
+                        text = format_b(CFG_BRANCH_NAMES[(inst >> 12) & 0b111], 0, (inst >> 15) & 0b11111, (inst >> 20) & 0b11111, branch_offset(inst))
+                    elif kind in (CFG_JUMP, CFG_CALL):
+                        text = format_u("jal", (inst >> 7) & 0b11111, 0, 0, jal_offset(inst))
+                    if target is not None:
+                        text += f"  # -> {self.target_label(target)}"
+                    elif kind in (CFG_BRANCH, CFG_JUMP, CFG_CALL):
+                        text += "  # -> outside the binary"
+                    else:
+                        text += f"  # {kind}"
+                lines.append(f"  inst {i}: {inst:08x} {text}\n")
+            if len(lines) >= 4096:
+                file.write("".join(lines))
+                lines = []
+        file.write("".join(lines))
+
+    def to_json(self):
+        return {
+            "instructions": self.num_words,
+            "blocks": [{
+                "id": block,
+                "label": self.label(block),
+                "start": start,
+                "end": end,
+                "terminator": self.terminators.get(end - 1, (None,))[0],
+                "successors": [{"block": successor, "kind": kind} for successor, kind in self.successors[block]],
+                "idom": self.idom[block],
+                "loop": self.loop_of[block],
+            } for block, (start, end) in enumerate(zip(self.starts, self.ends))],
+            "call_targets": sorted(self.call_targets),
+            "external_targets": sorted(self.external_targets),
+            "back_edges": [list(edge) for edge in self.back_edges],
+            "loops": [{"header": header, "latches": latches, "parent": parent} for header, (latches, parent) in self.loops.items()],
+        }
+
+    def write_dot(self, file):
+        back_edges = set(self.back_edges)
+        print("digraph cfg {", file=file)
+        print("  node [shape=box, fontname=monospace];", file=file)
+        for block, (start, end) in enumerate(zip(self.starts, self.ends)):
+            shape = ", style=bold" if block in self.loops else ""
+            print(f'  b{block} [label="{self.label(block)}\\ninst {start}-{end - 1}"{shape}];', file=file)
+        for block, successors in enumerate(self.successors):
+            for successor, kind in successors:
+                style = ", color=red" if (block, successor) in back_edges else ""
+                print(f'  b{block} -> b{successor} [label="{kind}"{style}];', file=file)
+        print("}", file=file)
+########## CONTROL-FLOW ANALYSIS ##########
+
 ########## MAIN PROGRAM ##########
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Disassemble a RISC-V binary")
+    parser.add_argument("file_name", nargs="?", default="proj1_5.bin")
+    parser.add_argument("--batch", action="store_true",
+                        help="extract instruction fields for the whole binary at once with NumPy")
+    parser.add_argument("--cache-size", type=int, default=DISASSEMBLY_CACHE_SIZE,
+                        help="entries in the disassembly LRU cache (0 disables it)")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="report the disassembly cache hit rate on stderr")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="disassemble chunks of the binary in N worker processes")
+    parser.add_argument("--decode-cache", metavar="DIR",
+                        help="keep finished listings in DIR so later runs on the same binary just print them")
+    parser.add_argument("--decode-cache-size", type=int, default=LISTING_CACHE_SIZE >> 20, metavar="MB",
+                        help="size limit of the --decode-cache directory, least recently used entries go first")
+    parser.add_argument("--cfg", action="store_true",
+                        help="print a listing labelled by basic block, with branch targets, loops and calls")
+    parser.add_argument("--cfg-dot", metavar="FILE",
+                        help="write the control-flow graph to FILE in Graphviz DOT format")
+    parser.add_argument("--cfg-json", metavar="FILE",
+                        help="write the control-flow graph to FILE as JSON")
+    args = parser.parse_args(argv)
+    if args.batch and np is None:
+        parser.error("--batch needs NumPy installed")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
 def main():
-    file_name = "proj1_5.bin"
-    # file_name = sys.argv[1]
-    file_contents = read_file(file_name)
-    instructions = get_instructions(file_contents)
-    
+    args = parse_args(sys.argv[1:])
+    if args.cfg or args.cfg_dot or args.cfg_json:
+        cfg = ControlFlowGraph(load_instructions(args.file_name))
+        if args.cfg:
+            cfg.listing(cache_size=args.cache_size)
+        if args.cfg_dot:
+            with open(args.cfg_dot, "w") as f:
+                cfg.write_dot(f)
+        if args.cfg_json:
+            with open(args.cfg_json, "w") as f:
+                json.dump(cfg.to_json(), f)
+        print(cfg.summary(), file=sys.stderr)
+        return
+    if args.decode_cache is not None:
+        print_cached_listing(args.file_name, args.decode_cache, args.decode_cache_size << 20,
+                             args.jobs, args.batch, args.cache_size, args.cache_stats)
+        return
+    if args.jobs > 1:
+        print_parallel(args.file_name, args.jobs, args.batch, args.cache_size, args.cache_stats)
+        return
+    if args.batch:
+        print_batch(args.file_name)
+        return
+
+    # Words are read straight out of the mapped file as the listing is printed
+    instructions = load_instructions(args.file_name)
+
+    disassemble = make_disassembly_cache(args.cache_size)
+
     for i, instruction in enumerate(instructions):
-        disassembled_instruction = disassemble_instruction(instruction)
+        disassembled_instruction = disassemble(instruction)
         print(f"inst {i}: {instruction:08x} {disassembled_instruction}")
 
+    if args.cache_stats:
+        report_disassembly_cache(disassemble)
+
 if __name__ == "__main__":
     main()
 ########## MAIN PROGRAM ##########
\ No newline at end of file
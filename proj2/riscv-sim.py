@@ -1,8 +1,37 @@
 # Proj2
 # Rio Pramana - 2023318129
 
-import sys # for receiving the command line argument
-from collections import defaultdict # for data memory
+import argparse # for parsing the command line arguments
+import asyncio # for the simulation server
+import base64 # for programs sent inline to the server
+import contextlib # for capturing console output of batch jobs
+import functools # for the disassembly cache
+import gzip # for compressed execution traces
+import hashlib # for keying the server's program cache
+import importlib.util # for loading --plugin files
+import io
+import json # for batch manifests and results
+import mmap # for mapping large binaries instead of reading them in
+import multiprocessing # for the server's worker processes
+import os
+import queue # for the messages queued to the server's workers
+import random # for the random cache replacement policy
+import stat # for spotting stale server sockets
+import struct # for packing words into data memory pages
+import sys
+import threading # for the threads feeding the server's workers
+import time
+import zlib # for the program checksum in snapshots
+from array import array # for byte-swapping words on big-endian hosts
+from collections import OrderedDict, defaultdict # for the server's program cache and profiler counts
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # for batch runs and server workers
+
+try:
+    import zstandard # optional, only needed for zstd execution traces
+except ImportError:
+    zstandard = None
+
+DISASSEMBLY_CACHE_SIZE = 4096
 
 ########## HELPER FUNCTIONS ##########
 def read_file(file_name):
@@ -10,447 +39,2710 @@ def read_file(file_name):
         file_contents = f.read()
     return file_contents
 
+def map_file(file_name):
+    # Memory-map the file read-only (empty files can't be mapped)
+    with open(file_name, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""
+
+class InstructionStream:
+    # Zero-copy view of a binary as little-endian 32-bit instruction words
+    def __init__(self, file_contents):
+        view = memoryview(file_contents)
+        whole = len(view) - len(view) % 4
+        if sys.byteorder == "little":
+            self.words = view[:whole].cast("I")
+        else:
+            self.words = array("I", view[:whole])
+            self.words.byteswap()
+        self.num_words = whole // 4
+        # A trailing partial word is read as if zero padded
+        self.tail = int.from_bytes(view[whole:], byteorder = "little") if whole < len(view) else None
+
+    def __len__(self):
+        return self.num_words + (self.tail is not None)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if 0 <= i < self.num_words:
+            return self.words[i]
+        if i == self.num_words and self.tail is not None:
+            return self.tail
+        raise IndexError("instruction index out of range")
+
+    def __iter__(self):
+        yield from self.words
+        if self.tail is not None:
+            yield self.tail
+
 def get_instructions(file_contents):
-    instructions = []
-    for i in range(0, len(file_contents), 4):
-        instruction = int.from_bytes(file_contents[i:i + 4], byteorder = "little")
-        instructions.append(instruction)
-    return instructions
+    return InstructionStream(file_contents)
 
-def twos_complement(val, bits):
-    return (1 << bits) + val if val < 0 else val
+def load_instructions(file_name):
+    return InstructionStream(map_file(file_name))
 
 def sign_extend(val, bits):
     sign_bit = 1 << (bits - 1)
     return (val & (sign_bit - 1)) - (val & sign_bit)
 ########## HELPER FUNCTIONS ##########
 
+########## CONSOLE ##########
+CONSOLE_ADDRESS = 0x20000000
+CONSOLE_BUFFER_SIZE = 4096
+
+class Console:
+    # Memory-mapped console: a SW to CONSOLE_ADDRESS writes one character..
+    # ..and a LW reads one integer line. Output is buffered and flushed on..
+    # ..newline, when the buffer fills, before reading input and at exit
+    def __init__(self, output=None, input=None, buffer_size=CONSOLE_BUFFER_SIZE):
+        self.output = sys.stdout if output is None else output
+        self.input = sys.stdin if input is None else input
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write_char(self, value):
+        char = chr(value & 0xFF)
+        self.buffer.append(char)
+        if char == "\n" or len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.output.write("".join(self.buffer))
+            self.buffer.clear()
+
+    def read_int(self):
+        # Flush first so a prompt shows up before the program waits for input
+        self.flush()
+        self.output.flush()
+        line = self.input.readline()
+        if not line:
+            raise EOFError("EOF when reading a line")
+        return int(line)
+########## CONSOLE ##########
+
+########## DATA MEMORY ##########
+DATA_MEMORY_START = 0x10000000
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+EMPTY_PAGE = b"\xff" * PAGE_SIZE
+WORD = struct.Struct("<I")
+HALF = struct.Struct("<H")
+
+class DataMemory:
+    # Byte-addressable memory made of bytearray pages that are only..
+    # ..allocated on the first write, so untouched bytes read as 0xFF
+    # The console sits on the same bus, the handlers check for its address
+    def __init__(self, console=None):
+        self.pages = {}
+        self.console = Console() if console is None else console
+
+    def page(self, page_number):
+        page = self.pages.get(page_number)
+        if page is None:
+            page = self.pages[page_number] = bytearray(EMPTY_PAGE)
+        return page
+
+    def load_byte(self, addr):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return 0xFF
+        return page[addr & PAGE_MASK]
+
+    def store_byte(self, addr, value):
+        self.page(addr >> PAGE_BITS)[addr & PAGE_MASK] = value & 0xFF
+
+    # Accesses that straddle two pages go byte by byte through DataMemory's..
+    # ..own byte methods, so a subclass hooking the byte methods (like..
+    # ..CachedDataMemory) still sees one access per load or store
+    def load_half(self, addr):
+        offset = addr & PAGE_MASK
+        if offset > PAGE_SIZE - 2:
+            return DataMemory.load_byte(self, addr) | (DataMemory.load_byte(self, addr + 1) << 8)
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return 0xFFFF
+        return HALF.unpack_from(page, offset)[0]
+
+    def store_half(self, addr, value):
+        offset = addr & PAGE_MASK
+        if offset > PAGE_SIZE - 2:
+            DataMemory.store_byte(self, addr, value)
+            DataMemory.store_byte(self, addr + 1, value >> 8)
+        else:
+            HALF.pack_into(self.page(addr >> PAGE_BITS), offset, value & 0xFFFF)
+
+    def load_word(self, addr):
+        offset = addr & PAGE_MASK
+        if offset > PAGE_SIZE - 4:
+            # Word straddles two pages
+            load_byte = DataMemory.load_byte
+            return load_byte(self, addr) | (load_byte(self, addr + 1) << 8) | (load_byte(self, addr + 2) << 16) | (load_byte(self, addr + 3) << 24)
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return 0xFFFFFFFF
+        return WORD.unpack_from(page, offset)[0]
+
+    def store_word(self, addr, value):
+        offset = addr & PAGE_MASK
+        if offset > PAGE_SIZE - 4:
+            for i in range(4):
+                DataMemory.store_byte(self, addr + i, value >> (8 * i))
+        else:
+            WORD.pack_into(self.page(addr >> PAGE_BITS), offset, value & 0xFFFFFFFF)
+
+    def load(self, addr, contents):
+        # Copy a whole file image in, one slice per page
+        contents = memoryview(contents)
+        i = 0
+        while i < len(contents):
+            offset = (addr + i) & PAGE_MASK
+            n = min(PAGE_SIZE - offset, len(contents) - i)
+            self.page((addr + i) >> PAGE_BITS)[offset:offset + n] = contents[i:i + n]
+            i += n
+########## DATA MEMORY ##########
+
+########## REGISTER FILE ##########
+# x0..x31 are kept as canonical unsigned 32-bit words, every handler masks..
+# ..what it writes. Decode points rd=0 at an extra sink slot so writes to..
+# ..x0 vanish without an "if rd != 0" per handler
+# A plain list beats array('I') here, its element reads and range-checked..
+# ..writes cost more than the masking they'd replace
+NUM_REGISTERS = 32
+X0_SINK = 32
+
+def make_registers():
+    return [0] * (NUM_REGISTERS + 1)
+
+def register_dump(registers):
+    return [f"x{i}: {registers[i]:#010x}" for i in range(NUM_REGISTERS)]
+########## REGISTER FILE ##########
+
+########## INSTRUCTION HANDLERS ##########
+# Every handler takes the fields of a pre-decoded record and returns the next pc
+# Signed compares flip the sign bit, which orders words as signed ints
+
+# LUI instruction
+def exec_lui(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = imm & 0xFFFFFFFF
+    return pc + 4
+
+# AUIPC instruction
+def exec_auipc(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+# JAL instruction
+# Jump and branch targets wrap around like the pc does, so one below 0..
+# ..lands past the end of the program and stops the run
+def exec_jal(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (pc + 4) & 0xFFFFFFFF
+    return (pc + imm) & 0xFFFFFFFF
+
+# JALR instruction
+def exec_jalr(registers, data_memory, pc, rd, rs1, rs2, imm):
+    tmp = (registers[rs1] + imm) & 0xFFFFFFFE
+    registers[rd] = (pc + 4) & 0xFFFFFFFF
+    return tmp
+
+# Branch instructions
+def exec_beq(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] == registers[rs2]:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_bne(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] != registers[rs2]:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_blt(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] ^ 0x80000000 < registers[rs2] ^ 0x80000000:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_bge(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] ^ 0x80000000 >= registers[rs2] ^ 0x80000000:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_bltu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] < registers[rs2]:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_bgeu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    if registers[rs1] >= registers[rs2]:
+        return (pc + imm) & 0xFFFFFFFF
+    return pc + 4
+
+# Load instructions
+def exec_lw(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        registers[rd] = data_memory.console.read_int() & 0xFFFFFFFF
+    else:
+        registers[rd] = data_memory.load_word(mem_addr)
+    return pc + 4
+
+# Byte and halfword loads, a console read is cut down to the access width
+def exec_lb(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        value = data_memory.console.read_int() & 0xFF
+    else:
+        value = data_memory.load_byte(mem_addr)
+    registers[rd] = ((value ^ 0x80) - 0x80) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_lh(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        value = data_memory.console.read_int() & 0xFFFF
+    else:
+        value = data_memory.load_half(mem_addr)
+    registers[rd] = ((value ^ 0x8000) - 0x8000) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_lbu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        registers[rd] = data_memory.console.read_int() & 0xFF
+    else:
+        registers[rd] = data_memory.load_byte(mem_addr)
+    return pc + 4
+
+def exec_lhu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        registers[rd] = data_memory.console.read_int() & 0xFFFF
+    else:
+        registers[rd] = data_memory.load_half(mem_addr)
+    return pc + 4
+
+# Store instructions
+def exec_sw(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        data_memory.console.write_char(registers[rs2])
+    else:
+        data_memory.store_word(mem_addr, registers[rs2])
+    return pc + 4
+
+# Byte and halfword stores, any of them can print a character
+def exec_sb(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        data_memory.console.write_char(registers[rs2])
+    else:
+        data_memory.store_byte(mem_addr, registers[rs2])
+    return pc + 4
+
+def exec_sh(registers, data_memory, pc, rd, rs1, rs2, imm):
+    mem_addr = (registers[rs1] + imm) & 0xFFFFFFFF
+    if mem_addr == CONSOLE_ADDRESS:
+        data_memory.console.write_char(registers[rs2])
+    else:
+        data_memory.store_half(mem_addr, registers[rs2])
+    return pc + 4
+
+# ALU instructions
+def exec_addi(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] + imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_slti(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = 1 if registers[rs1] ^ 0x80000000 < (imm & 0xFFFFFFFF) ^ 0x80000000 else 0
+    return pc + 4
+
+def exec_sltiu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = 1 if registers[rs1] < (imm & 0xFFFFFFFF) else 0
+    return pc + 4
+
+def exec_xori(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] ^ imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_ori(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] | imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_andi(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] & imm
+    return pc + 4
+
+def exec_slli(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] << imm) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_srli(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] >> imm
+    return pc + 4
+
+def exec_srai(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (((registers[rs1] ^ 0x80000000) - 0x80000000) >> imm) & 0xFFFFFFFF
+    return pc + 4
+
+# R-type ALU instructions
+def exec_add(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] + registers[rs2]) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_sub(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] - registers[rs2]) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_sll(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] << (registers[rs2] & 0x1F)) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_slt(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = 1 if registers[rs1] ^ 0x80000000 < registers[rs2] ^ 0x80000000 else 0
+    return pc + 4
+
+def exec_sltu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = 1 if registers[rs1] < registers[rs2] else 0
+    return pc + 4
+
+def exec_xor(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] ^ registers[rs2]
+    return pc + 4
+
+def exec_srl(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] >> (registers[rs2] & 0x1F)
+    return pc + 4
+
+def exec_sra(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (((registers[rs1] ^ 0x80000000) - 0x80000000) >> (registers[rs2] & 0x1F)) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_or(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] | registers[rs2]
+    return pc + 4
+
+def exec_and(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = registers[rs1] & registers[rs2]
+    return pc + 4
+
+# M extension, division rounds towards zero and never traps: dividing by..
+# ..zero gives all ones (or the dividend for REM), and the one signed..
+# ..overflow case falls out of the 32-bit wrap
+def exec_mul(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] * registers[rs2]) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_mulh(registers, data_memory, pc, rd, rs1, rs2, imm):
+    product = ((registers[rs1] ^ 0x80000000) - 0x80000000) * ((registers[rs2] ^ 0x80000000) - 0x80000000)
+    registers[rd] = (product >> 32) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_mulhsu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    product = ((registers[rs1] ^ 0x80000000) - 0x80000000) * registers[rs2]
+    registers[rd] = (product >> 32) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_mulhu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    registers[rd] = (registers[rs1] * registers[rs2]) >> 32
+    return pc + 4
+
+def exec_div(registers, data_memory, pc, rd, rs1, rs2, imm):
+    dividend = (registers[rs1] ^ 0x80000000) - 0x80000000
+    divisor = (registers[rs2] ^ 0x80000000) - 0x80000000
+    if divisor == 0:
+        registers[rd] = 0xFFFFFFFF
+    else:
+        quotient = abs(dividend) // abs(divisor)
+        if (dividend < 0) != (divisor < 0):
+            quotient = -quotient
+        registers[rd] = quotient & 0xFFFFFFFF
+    return pc + 4
+
+def exec_divu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    divisor = registers[rs2]
+    registers[rd] = registers[rs1] // divisor if divisor else 0xFFFFFFFF
+    return pc + 4
+
+def exec_rem(registers, data_memory, pc, rd, rs1, rs2, imm):
+    dividend = (registers[rs1] ^ 0x80000000) - 0x80000000
+    divisor = (registers[rs2] ^ 0x80000000) - 0x80000000
+    if divisor == 0:
+        registers[rd] = registers[rs1]
+    else:
+        remainder = abs(dividend) % abs(divisor)
+        registers[rd] = (-remainder if dividend < 0 else remainder) & 0xFFFFFFFF
+    return pc + 4
+
+def exec_remu(registers, data_memory, pc, rd, rs1, rs2, imm):
+    divisor = registers[rs2]
+    registers[rd] = registers[rs1] % divisor if divisor else registers[rs1]
+    return pc + 4
+
+# Encodings with nothing to simulate (fence, ecall/ebreak with no OS or..
+# ..debugger, unlisted funct3/funct7 of a known opcode) just fall through
+def exec_nop(registers, data_memory, pc, rd, rs1, rs2, imm):
+    return pc + 4
+
+def exec_unknown(registers, data_memory, pc, rd, rs1, rs2, imm):
+    # Keep the message in order with what the program already printed
+    data_memory.console.flush()
+    print("unknown instruction")
+    return pc + 4
+########## INSTRUCTION HANDLERS ##########
+
+########## DECODE STAGE ##########
+# Immediate decoders, one per instruction format. They sign-extend with..
+# ..(x ^ sign bit) - sign bit inline, the per-step decode calls them a lot
+def imm_none(inst):
+    return 0
+
+def imm_i(inst):
+    return (((inst >> 20) & 0xFFF) ^ 0x800) - 0x800
+
+def imm_shamt(inst):
+    return (inst >> 20) & 0x1F
+
+def imm_s(inst):
+    imm_11_5 = (inst >> 25) & 0b1111111
+    imm_4_0 = (inst >> 7) & 0b11111
+    return (((imm_11_5 << 5) | imm_4_0) ^ 0x800) - 0x800
+
+def imm_b(inst):
+    imm_11 = (inst >> 7) & 0b1
+    imm_1_4 = (inst >> 8) & 0b1111
+    imm_5_10 = (inst >> 25) & 0b111111
+    imm_12 = (inst >> 31) & 0b1
+    imm = (imm_12 << 12) | (imm_11 << 11) | (imm_5_10 << 5) | (imm_1_4 << 1)
+    return (imm ^ 0x1000) - 0x1000
+
+def imm_u(inst):
+    return (((inst >> 12) ^ 0x80000) - 0x80000) << 12
+
+def imm_j(inst):
+    imm_20 = (inst >> 31) & 0b1
+    imm_1_10 = (inst >> 21) & 0b1111111111
+    imm_11 = (inst >> 20) & 0b1
+    imm_12_19 = (inst >> 12) & 0b11111111
+    imm = (imm_20 << 20) | (imm_12_19 << 12) | (imm_11 << 11) | (imm_1_10 << 1)
+    # Sign-extending to 32 bits
+    return (imm ^ 0x100000) - 0x100000
+
+# Assembly text, one per instruction format
+def format_r(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, x{rs1}, x{rs2}"
+
+def format_i(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, x{rs1}, {imm}"
+
+def format_mem_rd(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, {imm}(x{rs1})"
+
+def format_mem_rs2(name, rd, rs1, rs2, imm):
+    return f"{name} x{rs2}, {imm}(x{rs1})"
+
+def format_b(name, rd, rs1, rs2, imm):
+    return f"{name} x{rs1}, x{rs2}, {imm}"
+
+def format_system(name, rd, rs1, rs2, imm):
+    # ecall and ebreak share a key, only bit 20 (the low bit of rs2) tells them apart
+    if name == "ecall" and rs2 == 1:
+        return "ebreak"
+    return name
+
+def format_u(name, rd, rs1, rs2, imm):
+    return f"{name} x{rd}, {imm}"
+
+# (opcode, funct3, funct7) -> (mnemonic, immediate decoder, formatter, handler)
+# None in a key means the field is not part of the encoding
+INSTRUCTION_TABLE = {
+    (0b0110111, None, None): ("lui", imm_u, format_u, exec_lui),
+    (0b0010111, None, None): ("auipc", imm_u, format_u, exec_auipc),
+    (0b1101111, None, None): ("jal", imm_j, format_u, exec_jal),
+    (0b1100111, 0b000, None): ("jalr", imm_i, format_mem_rd, exec_jalr),
+
+    (0b1100011, 0b000, None): ("beq", imm_b, format_b, exec_beq),
+    (0b1100011, 0b001, None): ("bne", imm_b, format_b, exec_bne),
+    (0b1100011, 0b100, None): ("blt", imm_b, format_b, exec_blt),
+    (0b1100011, 0b101, None): ("bge", imm_b, format_b, exec_bge),
+    (0b1100011, 0b110, None): ("bltu", imm_b, format_b, exec_bltu),
+    (0b1100011, 0b111, None): ("bgeu", imm_b, format_b, exec_bgeu),
+
+    (0b0000011, 0b000, None): ("lb", imm_i, format_mem_rd, exec_lb),
+    (0b0000011, 0b001, None): ("lh", imm_i, format_mem_rd, exec_lh),
+    (0b0000011, 0b010, None): ("lw", imm_i, format_mem_rd, exec_lw),
+    (0b0000011, 0b100, None): ("lbu", imm_i, format_mem_rd, exec_lbu),
+    (0b0000011, 0b101, None): ("lhu", imm_i, format_mem_rd, exec_lhu),
+
+    (0b0100011, 0b000, None): ("sb", imm_s, format_mem_rs2, exec_sb),
+    (0b0100011, 0b001, None): ("sh", imm_s, format_mem_rs2, exec_sh),
+    (0b0100011, 0b010, None): ("sw", imm_s, format_mem_rs2, exec_sw),
+
+    (0b0010011, 0b000, None): ("addi", imm_i, format_i, exec_addi),
+    (0b0010011, 0b010, None): ("slti", imm_i, format_i, exec_slti),
+    (0b0010011, 0b011, None): ("sltiu", imm_i, format_i, exec_sltiu),
+    (0b0010011, 0b100, None): ("xori", imm_i, format_i, exec_xori),
+    (0b0010011, 0b110, None): ("ori", imm_i, format_i, exec_ori),
+    (0b0010011, 0b111, None): ("andi", imm_i, format_i, exec_andi),
+    (0b0010011, 0b001, None): ("slli", imm_shamt, format_i, exec_slli),
+    (0b0010011, 0b101, 0b0000000): ("srli", imm_shamt, format_i, exec_srli),
+    (0b0010011, 0b101, 0b0100000): ("srai", imm_shamt, format_i, exec_srai),
+
+    (0b0110011, 0b000, 0b0000000): ("add", imm_none, format_r, exec_add),
+    (0b0110011, 0b000, 0b0100000): ("sub", imm_none, format_r, exec_sub),
+    (0b0110011, 0b001, 0b0000000): ("sll", imm_none, format_r, exec_sll),
+    (0b0110011, 0b010, 0b0000000): ("slt", imm_none, format_r, exec_slt),
+    (0b0110011, 0b011, 0b0000000): ("sltu", imm_none, format_r, exec_sltu),
+    (0b0110011, 0b100, 0b0000000): ("xor", imm_none, format_r, exec_xor),
+    (0b0110011, 0b101, 0b0000000): ("srl", imm_none, format_r, exec_srl),
+    (0b0110011, 0b101, 0b0100000): ("sra", imm_none, format_r, exec_sra),
+    (0b0110011, 0b110, 0b0000000): ("or", imm_none, format_r, exec_or),
+    (0b0110011, 0b111, 0b0000000): ("and", imm_none, format_r, exec_and),
+
+    (0b0110011, 0b000, 0b0000001): ("mul", imm_none, format_r, exec_mul),
+    (0b0110011, 0b001, 0b0000001): ("mulh", imm_none, format_r, exec_mulh),
+    (0b0110011, 0b010, 0b0000001): ("mulhsu", imm_none, format_r, exec_mulhsu),
+    (0b0110011, 0b011, 0b0000001): ("mulhu", imm_none, format_r, exec_mulhu),
+    (0b0110011, 0b100, 0b0000001): ("div", imm_none, format_r, exec_div),
+    (0b0110011, 0b101, 0b0000001): ("divu", imm_none, format_r, exec_divu),
+    (0b0110011, 0b110, 0b0000001): ("rem", imm_none, format_r, exec_rem),
+    (0b0110011, 0b111, 0b0000001): ("remu", imm_none, format_r, exec_remu),
+
+    (0b0001111, None, None): ("fence", imm_none, format_system, exec_nop),
+    (0b1110011, 0b000, None): ("ecall", imm_none, format_system, exec_nop),
+}
+
+# Opcodes whose unlisted funct3/funct7 combinations are skipped silently..
+# ..instead of being reported as unknown instructions
+PARTIAL_OPCODES = {0b1100011, 0b0000011, 0b0100011, 0b0010011, 0b0110011}
+
+# The opcode, funct3 and funct7 bits of an instruction word, left in place
+OPCODE_FIELDS_MASK = 0xFE00707F
+
+class OpcodeTable(dict):
+    # Flat table keyed by inst & OPCODE_FIELDS_MASK, so a lookup is a single..
+    # ..probe with no wildcard fallbacks. Keys it wasn't built with (encodings..
+    # ..INSTRUCTION_TABLE doesn't list) get fallback(key) on first use
+    def __init__(self, entries, fallback):
+        super().__init__(entries)
+        self.fallback = fallback
+
+    def __missing__(self, key):
+        value = self[key] = self.fallback(key)
+        return value
+
+def expand_instruction_table():
+    # INSTRUCTION_TABLE with its wildcard keys spelled out, one key per..
+    # ..funct3/funct7 value they stand for
+    entries = {}
+    # Fill the wildcard keys first so the exact ones win
+    keys = sorted(INSTRUCTION_TABLE, key=lambda key: (key[1] is not None, key[2] is not None))
+    for key in keys:
+        opcode, funct3, funct7 = key
+        for f3 in range(8) if funct3 is None else (funct3,):
+            for f7 in range(128) if funct7 is None else (funct7,):
+                entries[opcode | f3 << 12 | f7 << 25] = INSTRUCTION_TABLE[key]
+    return entries
+
+def decode_fallback(key):
+    return (exec_nop if key & 0b1111111 in PARTIAL_OPCODES else exec_unknown), imm_none
+
+INSTRUCTION_LOOKUP = OpcodeTable(expand_instruction_table(), lambda key: None)
+# (handler, immediate decoder) per key
+DECODE_LOOKUP = OpcodeTable({key: (entry[3], entry[1]) for key, entry in INSTRUCTION_LOOKUP.items()}, decode_fallback)
+
+def lookup_instruction(inst):
+    return INSTRUCTION_LOOKUP[inst & OPCODE_FIELDS_MASK]
+
+def decode_instruction(inst):
+    # Turn an instruction word into a (handler, rd, rs1, rs2, imm) record..
+    # ..so the bit slicing only happens once per static instruction
+    handler, decode_imm = DECODE_LOOKUP[inst & OPCODE_FIELDS_MASK]
+    return (handler, ((inst >> 7) & 0b11111) or X0_SINK, (inst >> 15) & 0b11111, (inst >> 20) & 0b11111, decode_imm(inst))
+
+class DecodedProgram(dict):
+    # Maps instruction index -> record, decoding each word the first time..
+    # ..it's fetched so code that never runs is never decoded
+    def __init__(self, instructions):
+        super().__init__()
+        self.instructions = instructions
+
+    def __missing__(self, i):
+        record = self[i] = decode_instruction(self.instructions[i])
+        return record
+
+    def __len__(self):
+        return len(self.instructions)
+
+def decode_program(instructions):
+    return DecodedProgram(instructions)
+
+class HandlerTable(dict):
+    # handler -> per-handler data for the run loops. The fetch layers wrap..
+    # ..handlers with functools.wraps, a wrapper looks up what it wraps
+    def __missing__(self, handler):
+        wrapped = getattr(handler, "__wrapped__", None)
+        if wrapped is None:
+            raise KeyError(handler)
+        value = self[handler] = self[wrapped]
+        return value
+########## DECODE STAGE ##########
+
+########## DECODE CACHE ##########
+# Decoded programs saved to disk, one file per binary named after a hash of..
+# ..the binary and of this script, so any change to the simulator starts..
+# ..a fresh set of entries. Layout (little-endian):
+#   magic, number of records (u64)
+#   per instruction word: handler index, rd, rs1, rs2 (u8 each), imm (i32)
+# Hits are touched, and the least recently used files are deleted once the..
+# ..directory grows past its size limit
+DECODE_CACHE_MAGIC = b"RVDEC001"
+DECODE_CACHE_HEADER = struct.Struct("<8sQ")
+DECODE_CACHE_RECORD = struct.Struct("<BBBBi")
+DECODE_CACHE_SUFFIX = ".rvdc"
+DECODE_CACHE_SIZE = 64 << 20
+
+DECODE_HANDLERS = tuple(dict.fromkeys([entry[3] for entry in INSTRUCTION_TABLE.values()] + [exec_nop, exec_unknown]))
+HANDLER_INDEX = {handler: i for i, handler in enumerate(DECODE_HANDLERS)}
+
+@functools.lru_cache(maxsize=None)
+def tool_version():
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def decode_cache_path(directory, contents):
+    key = hashlib.sha256(tool_version())
+    key.update(contents)
+    return os.path.join(directory, key.hexdigest() + DECODE_CACHE_SUFFIX)
+
+class MappedProgram(DecodedProgram):
+    # Decoded program backed by a cache file's records, still only..
+    # ..unpacked the first time each one is fetched
+    def __init__(self, instructions, table):
+        super().__init__(instructions)
+        self.table = table
+
+    def __missing__(self, i):
+        if not 0 <= i < len(self):
+            return super().__missing__(i)
+        handler, rd, rs1, rs2, imm = DECODE_CACHE_RECORD.unpack_from(
+            self.table, DECODE_CACHE_HEADER.size + i * DECODE_CACHE_RECORD.size)
+        record = self[i] = (DECODE_HANDLERS[handler], rd, rs1, rs2, imm)
+        return record
+
+def read_decode_cache(path, num_words):
+    # The mapped table, or None if there's no usable entry
+    try:
+        table = map_file(path)
+    except OSError:
+        return None
+    if len(table) != DECODE_CACHE_HEADER.size + num_words * DECODE_CACHE_RECORD.size \
+            or DECODE_CACHE_HEADER.unpack_from(table) != (DECODE_CACHE_MAGIC, num_words):
+        return None
+    return table
+
+def write_decode_cache(path, instructions):
+    # Decodes every word into a new table and saves it, returns the table
+    record_size = DECODE_CACHE_RECORD.size
+    table = bytearray(DECODE_CACHE_HEADER.size + len(instructions) * record_size)
+    DECODE_CACHE_HEADER.pack_into(table, 0, DECODE_CACHE_MAGIC, len(instructions))
+    pack_into = DECODE_CACHE_RECORD.pack_into
+    offset = DECODE_CACHE_HEADER.size
+    for inst in instructions:
+        handler, rd, rs1, rs2, imm = decode_instruction(inst)
+        pack_into(table, offset, HANDLER_INDEX[handler], rd, rs1, rs2, imm)
+        offset += record_size
+    # Write under a temporary name so a concurrent run never maps half a file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(table)
+    os.replace(temp_path, path)
+    return table
+
+def evict_decode_cache(directory, limit):
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.name.endswith(DECODE_CACHE_SUFFIX):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        total -= size
+
+def load_program(file_name, cache_directory=None, cache_size=DECODE_CACHE_SIZE):
+    # Maps the binary and returns (instructions, decoded program), through..
+    # ..the decode cache when there's a directory for it
+    contents = map_file(file_name)
+    instructions = get_instructions(contents)
+    if cache_directory is None:
+        return instructions, decode_program(instructions)
+    path = decode_cache_path(cache_directory, contents)
+    table = read_decode_cache(path, len(instructions))
+    if table is not None:
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return instructions, MappedProgram(instructions, table)
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        table = write_decode_cache(path, instructions)
+        evict_decode_cache(cache_directory, cache_size)
+    except OSError as e:
+        # The cache is only an optimisation, run without it
+        print(f"decode cache: {e}", file=sys.stderr)
+        return instructions, decode_program(instructions)
+    return instructions, MappedProgram(instructions, table)
+########## DECODE CACHE ##########
+
 ########## MAIN FUNCTIONS ##########
 def disassemble_instruction(inst):
-    opcode = inst & 0b1111111
-    rd = (inst >> 7) & 0b11111
-    rs1 = (inst >> 15) & 0b11111
-    rs2 = (inst >> 20) & 0b11111
-    funct3 = (inst >> 12) & 0b111
-    funct7 = (inst >> 25) & 0b1111111
-
-    # Disassemble the instruction based on its opcode..
-    # ..and funct3 and funct7 if necessary
-
-    # LUI instruction
-    if opcode == 0b0110111:
-        imm_20 = inst >> 12
-        imm = sign_extend(imm_20, 20) << 12
-        return f"lui x{rd}, {imm}"
-    
-    # AUIPC instruction
-    elif opcode == 0b0010111:
-        imm_20 = inst >> 12
-        imm = sign_extend(imm_20, 20) << 12
-        return f"auipc x{rd}, {imm}"
-    
-    # JAL instruction
-    elif opcode == 0b1101111:
-        imm_20 = (inst >> 31) & 0b1
-        imm_1_10 = (inst >> 21) & 0b1111111111
-        imm_11 = (inst >> 20) & 0b1
-        imm_12_19 = (inst >> 12) & 0b11111111
-        # Get the immediate/offset
-        imm = (imm_20 << 20) | (imm_12_19 << 12) | (imm_11 << 11) | (imm_1_10 << 1)
-        # Sign-extending to 32 bits
-        offset = sign_extend(imm, 21)
-        # Return the output string according to the format
-        return f"jal x{rd}, {offset}"
-    
-    # JALR instruction
-    elif opcode == 0b1100111:
-        if funct3 == 0b000:
-            imm = inst >> 20
-            return f"jalr x{rd}, {imm}(x{rs1})"
-        
-    # Branch instructions
-    elif opcode == 0b1100011:
-        imm_11 = (inst >> 7) & 0b1
-        imm_1_4 = (inst >> 8) & 0b1111
-        imm_5_10 = (inst >> 25) & 0b111111
-        imm_12 = (inst >> 31) & 0b1
-        imm = (imm_12 << 12) | (imm_11 << 11) | (imm_5_10 << 5) | (imm_1_4 << 1)
-        offset = sign_extend(imm, 12)
-        # Calculate the signed offset
-        if offset & (1 << 11):
-            offset = offset - (1 << 12)
-        # Apply 2s complement
-        offset = twos_complement(offset, 12)
-
-        if funct3 == 0b000:
-            return f"beq x{rs1}, x{rs2}, {offset}"
-        elif funct3 == 0b001:
-            return f"bne x{rs1}, x{rs2}, {offset}"
-        elif funct3 == 0b100:
-            return f"blt x{rs1}, x{rs2}, {offset}"
-        elif funct3 == 0b101:
-            return f"bge x{rs1}, x{rs2}, {offset}"
-        elif funct3 == 0b110:
-            return f"bltu x{rs1}, x{rs2}, {offset}"
-        elif funct3 == 0b111:
-            return f"bgeu x{rs1}, x{rs2}, {offset}"
-        
-    # Load instructions
-    elif opcode == 0b0000011:
-        imm = (inst >> 20) & 0xFFF
-        if imm & 0x800:
-            imm = (imm - 0x1000)
-            
-        if funct3 == 0b000:
-            return f"lb x{rd}, {imm}(x{rs1})"
-        elif funct3 == 0b001:
-            return f"lh x{rd}, {imm}(x{rs1})"
-        elif funct3 == 0b010:
-            return f"lw x{rd}, {imm}(x{rs1})"
-        elif funct3 == 0b100:
-            return f"lbu x{rd}, {imm}(x{rs1})"
-        elif funct3 == 0b101:
-            return f"lhu x{rd}, {imm}(x{rs1})"
-        
-    # Store instructions
-    elif opcode == 0b0100011:
-        imm_11_5 = (inst >> 25) & 0b1111111
-        imm_4_0 = inst >> 7 & 0b11111
-        imm = (imm_11_5 << 5) | imm_4_0
-        if imm >= (1 << 11):
-            imm -= 1 << 12
-
-        if funct3 == 0b000:
-            return f"sb x{rs2}, {imm}(x{rs1})"
-        elif funct3 == 0b001:
-            return f"sh x{rs2}, {imm}(x{rs1})"
-        elif funct3 == 0b010:
-            return f"sw x{rs2}, {imm}(x{rs1})"
-        
-    # ALU instructions
-    elif opcode == 0b0010011:
-        imm = (inst & 0xFFF00000) >> 20
-        shamt = (inst >> 20) & 0x1F
-        if imm & 0x800:
-            imm = imm - 0x1000
-
-        if funct3 == 0b000:
-            return f"addi x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b010:
-            return f"slti x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b011:
-            return f"sltiu x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b100:
-            return f"xori x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b110:
-            return f"ori x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b111:
-            return f"andi x{rd}, x{rs1}, {imm}"
-        elif funct3 == 0b001:
-            return f"slli x{rd}, x{rs1}, {shamt}"
-        elif funct3 == 0b101:
-            if funct7 == 0b0000000:
-                return f"srli x{rd}, x{rs1}, {shamt}"
-            elif funct7 == 0b0100000:
-                return f"srai x{rd}, x{rs1}, {shamt}"
-            
-    # R-type ALU instructions
-    elif opcode == 0b0110011:
-        if funct3 == 0b000 and funct7 == 0b0000000:
-            return f"add x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b000 and funct7 == 0b0100000:
-            return f"sub x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b001 and funct7 == 0b0000000:
-            return f"sll x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b010 and funct7 == 0b0000000:
-            return f"slt x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b011 and funct7 == 0b0000000:
-            return f"sltu x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b100 and funct7 == 0b0000000:
-            return f"xor x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b101 and funct7 == 0b0000000:
-            return f"srl x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b101 and funct7 == 0b0100000:
-            return f"sra x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b110 and funct7 == 0b0000000:
-            return f"or x{rd}, x{rs1}, x{rs2}"
-        elif funct3 == 0b111 and funct7 == 0b0000000:
-            return f"and x{rd}, x{rs1}, x{rs2}"
-    else:
+    entry = INSTRUCTION_LOOKUP[inst & OPCODE_FIELDS_MASK]
+    if entry is None:
         return "unknown instruction"
-    
-def execute_instruction(inst, pc, registers, data_memory):
-    opcode = inst & 0b1111111
+    name, decode_imm, format_inst, handler = entry
     rd = (inst >> 7) & 0b11111
     rs1 = (inst >> 15) & 0b11111
     rs2 = (inst >> 20) & 0b11111
-    funct3 = (inst >> 12) & 0b111
-    funct7 = (inst >> 25) & 0b1111111
-
-    # LUI instruction
-    if opcode == 0b0110111:
-        imm_20 = inst >> 12
-        imm = sign_extend(imm_20, 20) << 12
-        if rd != 0:
-            registers[rd] = imm
-    
-    # AUIPC instruction
-    elif opcode == 0b0010111:
-        imm_20 = inst >> 12
-        imm = sign_extend(imm_20, 20) << 12
-        if rd != 0:
-            registers[rd] = pc + imm
-    
-    # JAL instruction
-    elif opcode == 0b1101111:
-        imm_20 = (inst >> 31) & 0b1
-        imm_1_10 = (inst >> 21) & 0b1111111111
-        imm_11 = (inst >> 20) & 0b1
-        imm_12_19 = (inst >> 12) & 0b11111111
-        # Get the immediate/offset
-        imm = (imm_20 << 20) | (imm_12_19 << 12) | (imm_11 << 11) | (imm_1_10 << 1)
-        # Sign-extending to 32 bits
-        offset = sign_extend(imm, 21)
-        if rd != 0:
-            registers[rd] = pc + 4
-        pc += offset
-        return pc
+    return format_inst(name, rd, rs1, rs2, decode_imm(inst))
+
+def make_disassembly_cache(size=DISASSEMBLY_CACHE_SIZE):
+    # Bounded LRU cache in front of disassemble_instruction(), keyed by the..
+    # ..instruction word since the same encodings repeat a lot in real binaries
+    return functools.lru_cache(maxsize=size)(disassemble_instruction)
+
+def report_disassembly_cache(cached_disassemble, file=sys.stderr):
+    info = cached_disassemble.cache_info()
+    lookups = info.hits + info.misses
+    hit_rate = info.hits / lookups if lookups else 0.0
+    print(f"disassembly cache: {info.hits} hits, {info.misses} misses, {hit_rate:.1%} hit rate, "
+          f"{info.currsize}/{info.maxsize} entries", file=file)
+
+def execute_instruction(inst, pc, registers, data_memory):
+    # Decode and run a single instruction word (the run loop in main()..
+    # ..uses the pre-decoded records from decode_program() instead)
+    handler, decode_imm = DECODE_LOOKUP[inst & OPCODE_FIELDS_MASK]
+    return handler(registers, data_memory, pc, ((inst >> 7) & 0b11111) or X0_SINK, (inst >> 15) & 0b11111, (inst >> 20) & 0b11111,
+                   decode_imm(inst))
+
+def run_program(decoded, registers, data_memory, num_instructions, pc=0):
+    # Execute up to num_instructions pre-decoded records, returns the final pc
+    program_end = len(decoded) * 4
+    for _ in range(num_instructions):
+        if pc >= program_end:
+            break
+        handler, rd, rs1, rs2, imm = decoded[pc // 4]
+        pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+    return pc
+########## MAIN FUNCTIONS ##########
+
+########## BLOCK TRANSLATION ##########
+# Basic blocks (straight-line runs ending at a jump or branch) are turned..
+# ..into Python source once, compiled, and cached by their start pc
+MAX_BLOCK_LENGTH = 256
+
+BLOCK_ENDS = {exec_jal, exec_jalr, exec_beq, exec_bne, exec_blt, exec_bge, exec_bltu, exec_bgeu}
+
+# Python source for each handler, "r" is the register file and "m" the data memory
+# The pc-based constants (targets) come in already wrapped to 32 bits..
+# ..signed division and the signed high multiplies are left as handler calls
+TRANSLATIONS = {
+    exec_lui: "r[{rd}] = {imm} & 0xFFFFFFFF",
+    exec_auipc: "r[{rd}] = {target}",
+    exec_jal: "r[{rd}] = {next_pc}",
+    exec_jalr: "r[{rd}] = {next_pc}",
+    exec_beq: "",
+    exec_bne: "",
+    exec_blt: "",
+    exec_bge: "",
+    exec_bltu: "",
+    exec_bgeu: "",
+    exec_lw: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "if a == 0x20000000:\n"
+              "    r[{rd}] = m.console.read_int() & 0xFFFFFFFF\n"
+              "else:\n"
+              "    r[{rd}] = m.load_word(a)"),
+    exec_lb: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "v = m.console.read_int() & 0xFF if a == 0x20000000 else m.load_byte(a)\n"
+              "r[{rd}] = ((v ^ 0x80) - 0x80) & 0xFFFFFFFF"),
+    exec_lh: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "v = m.console.read_int() & 0xFFFF if a == 0x20000000 else m.load_half(a)\n"
+              "r[{rd}] = ((v ^ 0x8000) - 0x8000) & 0xFFFFFFFF"),
+    exec_lbu: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+               "r[{rd}] = m.console.read_int() & 0xFF if a == 0x20000000 else m.load_byte(a)"),
+    exec_lhu: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+               "r[{rd}] = m.console.read_int() & 0xFFFF if a == 0x20000000 else m.load_half(a)"),
+    exec_sw: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "if a == 0x20000000:\n"
+              "    m.console.write_char(r[{rs2}])\n"
+              "else:\n"
+              "    m.store_word(a, r[{rs2}])"),
+    exec_sb: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "if a == 0x20000000:\n"
+              "    m.console.write_char(r[{rs2}])\n"
+              "else:\n"
+              "    m.store_byte(a, r[{rs2}])"),
+    exec_sh: ("a = (r[{rs1}] + {imm}) & 0xFFFFFFFF\n"
+              "if a == 0x20000000:\n"
+              "    m.console.write_char(r[{rs2}])\n"
+              "else:\n"
+              "    m.store_half(a, r[{rs2}])"),
+    exec_addi: "r[{rd}] = (r[{rs1}] + {imm}) & 0xFFFFFFFF",
+    exec_slti: "r[{rd}] = 1 if r[{rs1}] ^ 0x80000000 < ({imm} & 0xFFFFFFFF) ^ 0x80000000 else 0",
+    exec_sltiu: "r[{rd}] = 1 if r[{rs1}] < ({imm} & 0xFFFFFFFF) else 0",
+    exec_xori: "r[{rd}] = (r[{rs1}] ^ {imm}) & 0xFFFFFFFF",
+    exec_ori: "r[{rd}] = (r[{rs1}] | {imm}) & 0xFFFFFFFF",
+    exec_andi: "r[{rd}] = r[{rs1}] & {imm}",
+    exec_slli: "r[{rd}] = (r[{rs1}] << {imm}) & 0xFFFFFFFF",
+    exec_srli: "r[{rd}] = r[{rs1}] >> {imm}",
+    exec_srai: "r[{rd}] = (((r[{rs1}] ^ 0x80000000) - 0x80000000) >> {imm}) & 0xFFFFFFFF",
+    exec_add: "r[{rd}] = (r[{rs1}] + r[{rs2}]) & 0xFFFFFFFF",
+    exec_sub: "r[{rd}] = (r[{rs1}] - r[{rs2}]) & 0xFFFFFFFF",
+    exec_sll: "r[{rd}] = (r[{rs1}] << (r[{rs2}] & 0x1F)) & 0xFFFFFFFF",
+    exec_slt: "r[{rd}] = 1 if r[{rs1}] ^ 0x80000000 < r[{rs2}] ^ 0x80000000 else 0",
+    exec_sltu: "r[{rd}] = 1 if r[{rs1}] < r[{rs2}] else 0",
+    exec_xor: "r[{rd}] = r[{rs1}] ^ r[{rs2}]",
+    exec_srl: "r[{rd}] = r[{rs1}] >> (r[{rs2}] & 0x1F)",
+    exec_sra: "r[{rd}] = (((r[{rs1}] ^ 0x80000000) - 0x80000000) >> (r[{rs2}] & 0x1F)) & 0xFFFFFFFF",
+    exec_or: "r[{rd}] = r[{rs1}] | r[{rs2}]",
+    exec_and: "r[{rd}] = r[{rs1}] & r[{rs2}]",
+    exec_mul: "r[{rd}] = (r[{rs1}] * r[{rs2}]) & 0xFFFFFFFF",
+    exec_mulhu: "r[{rd}] = (r[{rs1}] * r[{rs2}]) >> 32",
+    exec_divu: "r[{rd}] = r[{rs1}] // r[{rs2}] if r[{rs2}] else 0xFFFFFFFF",
+    exec_remu: "r[{rd}] = r[{rs1}] % r[{rs2}] if r[{rs2}] else r[{rs1}]",
+    exec_nop: "",
+}
+
+# How each block-ending handler picks the next pc
+BLOCK_EXITS = {
+    exec_jal: "return {target}",
+    exec_jalr: "return t",
+    exec_beq: "return {target} if r[{rs1}] == r[{rs2}] else {next_pc}",
+    exec_bne: "return {target} if r[{rs1}] != r[{rs2}] else {next_pc}",
+    exec_blt: "return {target} if r[{rs1}] ^ 0x80000000 < r[{rs2}] ^ 0x80000000 else {next_pc}",
+    exec_bge: "return {target} if r[{rs1}] ^ 0x80000000 >= r[{rs2}] ^ 0x80000000 else {next_pc}",
+    exec_bltu: "return {target} if r[{rs1}] < r[{rs2}] else {next_pc}",
+    exec_bgeu: "return {target} if r[{rs1}] >= r[{rs2}] else {next_pc}",
+}
+
+def translate_block(decoded, pc):
+    # Returns (block function, number of instructions in the block)
+    program_end = len(decoded) * 4
+    start_pc = pc
+    lines = []
+    handlers = {}
+    length = 0
+    while pc < program_end and length < MAX_BLOCK_LENGTH:
+        handler, rd, rs1, rs2, imm = decoded[pc // 4]
+        length += 1
+        fields = {"rd": rd, "rs1": rs1, "rs2": rs2, "imm": imm, "next_pc": pc + 4, "target": (pc + imm) & 0xFFFFFFFF}
+        if handler is exec_jalr:
+            # Read rs1 before rd is written, rd may be the same register
+            lines.append("t = (r[{rs1}] + {imm}) & 0xFFFFFFFE".format(**fields))
+        if handler in TRANSLATIONS:
+            source = TRANSLATIONS[handler]
+            if source:
+                lines.extend(source.format(**fields).split("\n"))
+        else:
+            # No inline translation, call the handler itself
+            name = f"h{len(handlers)}"
+            handlers[name] = handler
+            lines.append(f"{name}(r, m, {pc}, {rd}, {rs1}, {rs2}, {imm})")
+        pc += 4
+        if handler in BLOCK_ENDS:
+            lines.append(BLOCK_EXITS[handler].format(**fields))
+            break
+    else:
+        lines.append(f"return {pc}")
+
+    source = "def block(r, m):\n" + "".join(f"    {line}\n" for line in lines)
+    namespace = dict(handlers)
+    exec(compile(source, f"<block {start_pc:#x}>", "exec"), namespace)
+    return namespace["block"], length
+
+def run_translated(decoded, registers, data_memory, num_instructions, pc=0, blocks=None):
+    # Same contract as run_program(), but whole basic blocks run at once..
+    # ..pass the same blocks dict to keep translations across calls
+    program_end = len(decoded) * 4
+    if blocks is None:
+        blocks = {}
+    remaining = num_instructions
+    while remaining > 0 and pc < program_end:
+        block = blocks.get(pc)
+        if block is None:
+            block = blocks[pc] = translate_block(decoded, pc)
+        run_block, length = block
+        if length > remaining:
+            # Step limit lands inside this block, finish it one by one
+            return run_program(decoded, registers, data_memory, remaining, pc)
+        pc = run_block(registers, data_memory)
+        remaining -= length
+    return pc
+########## BLOCK TRANSLATION ##########
+
+########## SUPERINSTRUCTIONS ##########
+# Common adjacent pairs are fused into one record at the first pc so they..
+# ..cost a single dispatch, the second pc keeps its own record for jumps..
+# ..that land on it. Fused handlers reuse the record fields as noted
+FUSED_NAMES = ("lui+addi", "addi+bne", "slli+add")
+
+def make_fused_handlers(counts):
+    # Each program gets its own fused handlers, they bump their slot in..
+    # ..counts so the run loop knows how many extra steps retired
+    def exec_lui_addi(registers, data_memory, pc, rd, rs1, rs2, imm):
+        # lui rs1, rs2 / addi rd, rs1, .. with the finished constant in imm
+        counts[0] += 1
+        registers[rs1] = rs2
+        registers[rd] = imm
+        return pc + 8
+
+    def exec_addi_bne(registers, data_memory, pc, rd, rs1, rs2, imm):
+        # addi rd, rd, imm / bne rd, rs1, rs2
+        counts[1] += 1
+        value = registers[rd] = (registers[rd] + imm) & 0xFFFFFFFF
+        if value != registers[rs1]:
+            return (pc + 4 + rs2) & 0xFFFFFFFF
+        return pc + 8
+
+    def exec_slli_add(registers, data_memory, pc, rd, rs1, rs2, imm):
+        # slli rd, rs1, imm / add rd, rd, rs2 (either operand order)
+        counts[2] += 1
+        shifted = registers[rd] = (registers[rs1] << imm) & 0xFFFFFFFF
+        registers[rd] = (registers[rs2] + shifted) & 0xFFFFFFFF
+        return pc + 8
+
+    return (exec_lui_addi, exec_addi_bne, exec_slli_add)
 
-    # JALR instruction
-    elif opcode == 0b1100111 and funct3 == 0b000:
-        imm = (inst >> 20) & 0xFFF
-        imm = sign_extend(imm, 12)
-        tmp = registers[rs1] + imm
-        if rd != 0:
-            registers[rd] = pc + 4
-        pc = tmp & ~1
+# Matchers take the two decoded records and return the fused record's..
+# ..(rd, rs1, rs2, imm), or None if the pair isn't the idiom
+def fuse_lui_addi(first, second):
+    _, lui_rd, _, _, upper = first
+    _, rd, rs1, _, imm = second
+    if rs1 == lui_rd:
+        return (rd, lui_rd, upper & 0xFFFFFFFF, (upper + imm) & 0xFFFFFFFF)
+    return None
+
+def fuse_addi_bne(first, second):
+    _, rd, rs1, _, imm = first
+    _, _, bne_rs1, bne_rs2, offset = second
+    if rs1 != rd:
+        return None
+    if bne_rs1 == rd:
+        return (rd, bne_rs2, offset, imm)
+    if bne_rs2 == rd:
+        return (rd, bne_rs1, offset, imm)
+    return None
+
+def fuse_slli_add(first, second):
+    _, rd, rs1, _, shamt = first
+    _, add_rd, add_rs1, add_rs2, _ = second
+    if add_rd != rd:
+        return None
+    if add_rs1 == rd:
+        return (rd, rs1, add_rs2, shamt)
+    if add_rs2 == rd:
+        return (rd, rs1, add_rs1, shamt)
+    return None
+
+# (first handler, second handler) -> (index into FUSED_NAMES, matcher)
+FUSIONS = {
+    (exec_lui, exec_addi): (0, fuse_lui_addi),
+    (exec_addi, exec_bne): (1, fuse_addi_bne),
+    (exec_slli, exec_add): (2, fuse_slli_add),
+}
+
+class FusedProgram(dict):
+    # Decoded records with fusable pairs replaced at their first pc
+    def __init__(self, decoded):
+        super().__init__()
+        self.decoded = decoded
+        self.counts = [0] * len(FUSED_NAMES)
+        self.sites = [0] * len(FUSED_NAMES)
+        self.handlers = make_fused_handlers(self.counts)
+
+    def __missing__(self, i):
+        record = self.decoded[i]
+        if 0 <= i < len(self.decoded) - 1:
+            second = self.decoded[i + 1]
+            fusion = FUSIONS.get((record[0], second[0]))
+            if fusion is not None:
+                kind, match = fusion
+                fields = match(record, second)
+                if fields is not None:
+                    record = (self.handlers[kind],) + fields
+                    self.sites[kind] += 1
+        self[i] = record
+        return record
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def report(self, file=sys.stderr):
+        # Every fused execution retires two instructions in one dispatch
+        print(f"fusion: {sum(self.counts)} dispatches saved", file=file)
+        for name, sites, count in zip(FUSED_NAMES, self.sites, self.counts):
+            print(f"  {name:<10} {sites:>6} sites {count:>12} executions", file=file)
+
+def run_fused(fused, registers, data_memory, num_instructions, pc=0):
+    # run_program() over a FusedProgram. A fused record is two steps, so..
+    # ..each round runs half the remaining records at most and tallies the..
+    # ..extra steps from the fused counts, so the limit is never overshot..
+    # ..and a last single step runs unfused
+    program_end = len(fused) * 4
+    counts = fused.counts
+    remaining = num_instructions
+    while remaining > 1:
+        records = remaining // 2
+        fused_before = sum(counts)
+        for _ in range(records):
+            if pc >= program_end:
+                return pc
+            handler, rd, rs1, rs2, imm = fused[pc // 4]
+            pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+        remaining -= records + sum(counts) - fused_before
+    return run_program(fused.decoded, registers, data_memory, remaining, pc)
+########## SUPERINSTRUCTIONS ##########
+
+########## PROFILER ##########
+PROFILE_SAMPLE_EVERY = 64
+
+class Profiler:
+    # Execution counts per pc, and optionally sampled wall time per handler
+    def __init__(self, sample_time=False):
+        self.pc_counts = defaultdict(int)
+        self.sample_time = sample_time
+        self.handler_time = defaultdict(float)
+        self.handler_samples = defaultdict(int)
+
+    def report(self, instructions, top=20, cache_size=DISASSEMBLY_CACHE_SIZE, cache_stats=False, file=sys.stderr):
+        disassemble = make_disassembly_cache(cache_size)
+        total = sum(self.pc_counts.values())
+        if total == 0:
+            print("profile: no instructions executed", file=file)
+            return
+
+        # Mnemonic counts come from the pc counts, so the run loop only counts pcs
+        mnemonic_counts = defaultdict(int)
+        labels = {}
+        for pc, count in self.pc_counts.items():
+            labels[pc] = disassemble(instructions[pc // 4])
+            mnemonic_counts[labels[pc].split()[0]] += count
+
+        print(f"profile: {total} instructions, {len(self.pc_counts)} distinct pcs", file=file)
+        print("hot pcs:", file=file)
+        for pc, count in sorted(self.pc_counts.items(), key=lambda item: item[1], reverse=True)[:top]:
+            print(f"  {pc:#010x} {count:>12} {count / total:7.2%}  {labels[pc]}", file=file)
+        print("mnemonics:", file=file)
+        for name, count in sorted(mnemonic_counts.items(), key=lambda item: item[1], reverse=True):
+            print(f"  {name:<10} {count:>12} {count / total:7.2%}", file=file)
+        if self.handler_samples:
+            print(f"handler time (1 in {PROFILE_SAMPLE_EVERY} steps sampled):", file=file)
+            for handler, samples in sorted(self.handler_samples.items(), key=lambda item: item[1], reverse=True):
+                mean = self.handler_time[handler] / samples
+                print(f"  {handler.__name__:<14} {mean * 1e9:10.0f} ns/call over {samples} samples", file=file)
+        if cache_stats:
+            report_disassembly_cache(disassemble, file=file)
+
+def run_profiled(decoded, registers, data_memory, num_instructions, pc, profiler):
+    # run_program() plus the profiler bookkeeping, kept separate so the..
+    # ..plain loop pays nothing when profiling is off
+    program_end = len(decoded) * 4
+    pc_counts = profiler.pc_counts
+    if not profiler.sample_time:
+        for _ in range(num_instructions):
+            if pc >= program_end:
+                break
+            pc_counts[pc] += 1
+            handler, rd, rs1, rs2, imm = decoded[pc // 4]
+            pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
         return pc
 
-    # Branch instructions
-    elif opcode == 0b1100011:
-        imm_11 = (inst >> 7) & 0b1
-        imm_1_4 = (inst >> 8) & 0b1111
-        imm_5_10 = (inst >> 25) & 0b111111
-        imm_12 = (inst >> 31) & 0b1
-        imm = (imm_12 << 12) | (imm_11 << 11) | (imm_5_10 << 5) | (imm_1_4 << 1)
-        offset = sign_extend(imm, 12)
-        # Calculate the signed offset
-        if offset & (1 << 11):
-            offset = offset - (1 << 12)
-        # Apply 2s complement
-        offset = twos_complement(offset, 12)
-
-        # BEQ
-        if funct3 == 0b000 and registers[rs1] == registers[rs2]:
-            pc += offset
-            return pc
-        # BNE
-        elif funct3 == 0b001 and registers[rs1] != registers[rs2]:
-            pc += offset
-            return pc
-        # BLT
-        elif funct3 == 0b100 and registers[rs1] < registers[rs2]:
-            pc += offset
-            return pc
-        # BGE
-        elif funct3 == 0b101 and registers[rs1] >= registers[rs2]:
-            pc += offset
-            return pc
-        
-        # # BLTU
-        # elif funct3 == 0b110 and (registers[rs1] < registers[rs2] & 0xFFFFFFFF):
-        #     pc += offset
-        #     return pc
-        # # BGEU
-        # elif funct3 == 0b111 and (registers[rs1] >= registers[rs2] & 0xFFFFFFFF):
-        #     pc += offset
-        #     return pc
-        
-    # Load instructions
-    elif opcode == 0b0000011:
-        imm = (inst >> 20) & 0xFFF
-        if imm & 0x800:
-            imm = (imm - 0x1000)
-        
-        mem_addr = registers[rs1] + imm
-
-        # # LB
-        # if funct3 == 0b000:
-        #     registers[rd] = sign_extend(data_memory[mem_addr], 8)
-        # # LH
-        # elif funct3 == 0b001:
-        #     registers[rd] = sign_extend(data_memory[mem_addr] | (data_memory[mem_addr + 1] << 8), 16)
-
-        # LW
-        if funct3 == 0b010:
-            if mem_addr == 0x20000000:
-                registers[rd] = int(input())
+    handler_time = profiler.handler_time
+    handler_samples = profiler.handler_samples
+    perf_counter = time.perf_counter
+    for step in range(num_instructions):
+        if pc >= program_end:
+            break
+        pc_counts[pc] += 1
+        handler, rd, rs1, rs2, imm = decoded[pc // 4]
+        if step % PROFILE_SAMPLE_EVERY:
+            pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+        else:
+            start = perf_counter()
+            pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+            handler_time[handler] += perf_counter() - start
+            handler_samples[handler] += 1
+    return pc
+########## PROFILER ##########
+
+########## PIPELINE TIMING MODEL ##########
+# Classic IF/ID/EX/MEM/WB pipeline with full forwarding, so the only data..
+# ..hazard left is a load followed by an instruction that needs its result.
+# Branches and JALR resolve in EX (predict not-taken), JAL targets are known in ID
+PIPELINE_DEPTH = 5
+LOAD_USE_STALL = 1
+TAKEN_BRANCH_PENALTY = 2
+JAL_PENALTY = 1
+JALR_PENALTY = 2
+
+KIND_ALU = 0
+KIND_LOAD = 1
+KIND_BRANCH = 2
+KIND_JAL = 3
+KIND_JALR = 4
+READS_RS1 = 1
+READS_RS2 = 2
+
+# handler -> (kind, source registers read in EX)
+# Store data is forwarded straight into MEM, so stores only wait on rs1
+PIPELINE_CLASSES = {
+    exec_lui: (KIND_ALU, 0),
+    exec_auipc: (KIND_ALU, 0),
+    exec_jal: (KIND_JAL, 0),
+    exec_jalr: (KIND_JALR, READS_RS1),
+    exec_beq: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_bne: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_blt: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_bge: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_bltu: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_bgeu: (KIND_BRANCH, READS_RS1 | READS_RS2),
+    exec_lw: (KIND_LOAD, READS_RS1),
+    exec_lb: (KIND_LOAD, READS_RS1),
+    exec_lh: (KIND_LOAD, READS_RS1),
+    exec_lbu: (KIND_LOAD, READS_RS1),
+    exec_lhu: (KIND_LOAD, READS_RS1),
+    exec_sw: (KIND_ALU, READS_RS1),
+    exec_sb: (KIND_ALU, READS_RS1),
+    exec_sh: (KIND_ALU, READS_RS1),
+    exec_addi: (KIND_ALU, READS_RS1),
+    exec_slti: (KIND_ALU, READS_RS1),
+    exec_sltiu: (KIND_ALU, READS_RS1),
+    exec_xori: (KIND_ALU, READS_RS1),
+    exec_ori: (KIND_ALU, READS_RS1),
+    exec_andi: (KIND_ALU, READS_RS1),
+    exec_slli: (KIND_ALU, READS_RS1),
+    exec_srli: (KIND_ALU, READS_RS1),
+    exec_srai: (KIND_ALU, READS_RS1),
+    exec_add: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_sub: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_sll: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_slt: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_sltu: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_xor: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_srl: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_sra: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_or: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_and: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_mul: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_mulh: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_mulhsu: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_mulhu: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_div: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_divu: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_rem: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_remu: (KIND_ALU, READS_RS1 | READS_RS2),
+    exec_nop: (KIND_ALU, 0),
+    exec_unknown: (KIND_ALU, 0),
+}
+
+class PipelineModel:
+    def __init__(self):
+        self.classes = HandlerTable(PIPELINE_CLASSES)
+        # With a branch predictor only mispredicted branches flush
+        self.branch_unit = None
+        self.instructions = 0
+        self.load_use_stalls = 0
+        self.taken_branches = 0
+        self.branches = 0
+        self.jals = 0
+        self.jalrs = 0
+        # rd of the previous instruction when it was a load, else 0
+        self.pending_load_rd = 0
+
+    def stall_cycles(self):
+        if self.branch_unit is None:
+            branch_flushes = ("taken branch flushes", self.taken_branches * TAKEN_BRANCH_PENALTY)
+        else:
+            branch_flushes = ("mispredict flushes", self.branch_unit.total_mispredicts() * TAKEN_BRANCH_PENALTY)
+        return {
+            "load-use stalls": self.load_use_stalls * LOAD_USE_STALL,
+            branch_flushes[0]: branch_flushes[1],
+            "jal flushes": self.jals * JAL_PENALTY,
+            "jalr flushes": self.jalrs * JALR_PENALTY,
+        }
+
+    def cycles(self):
+        if self.instructions == 0:
+            return 0
+        # The first instruction takes the full depth to come out of WB
+        return self.instructions + (PIPELINE_DEPTH - 1) + sum(self.stall_cycles().values())
+
+    def report(self, file=sys.stderr):
+        cycles = self.cycles()
+        cpi = cycles / self.instructions if self.instructions else 0.0
+        print(f"pipeline: {self.instructions} instructions, {cycles} cycles, CPI {cpi:.3f}", file=file)
+        print(f"  {'pipeline fill':<22} {PIPELINE_DEPTH - 1 if self.instructions else 0:>12}", file=file)
+        for name, stall in self.stall_cycles().items():
+            print(f"  {name:<22} {stall:>12}", file=file)
+        if self.branches:
+            print(f"  {self.taken_branches} of {self.branches} branches taken", file=file)
+
+def run_timed(decoded, registers, data_memory, num_instructions, pc, model):
+    # run_program() plus the pipeline bookkeeping
+    program_end = len(decoded) * 4
+    classes = model.classes
+    pending_load_rd = model.pending_load_rd
+    retired = load_use = branches = taken = jals = jalrs = 0
+    for _ in range(num_instructions):
+        if pc >= program_end:
+            break
+        handler, rd, rs1, rs2, imm = decoded[pc // 4]
+        kind, reads = classes[handler]
+        if pending_load_rd and ((reads & READS_RS1 and rs1 == pending_load_rd) or (reads & READS_RS2 and rs2 == pending_load_rd)):
+            load_use += 1
+        next_pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+        if kind == KIND_ALU:
+            pending_load_rd = 0
+        elif kind == KIND_LOAD:
+            pending_load_rd = rd
+        else:
+            pending_load_rd = 0
+            if kind == KIND_BRANCH:
+                branches += 1
+                if next_pc != pc + 4:
+                    taken += 1
+            elif kind == KIND_JAL:
+                jals += 1
             else:
-                registers[rd] = data_memory[mem_addr] | (data_memory[mem_addr + 1] << 8) | (data_memory[mem_addr + 2] << 16) | (data_memory[mem_addr + 3] << 24)
-                registers[rd] = sign_extend(registers[rd], 32)
-
-        # # LBU
-        # elif funct3 == 0b100:
-        #     registers[rd] = data_memory[mem_addr]
-        # # LHU
-        # elif funct3 == 0b101:
-        #     registers[rd] = data_memory[mem_addr] | (data_memory[mem_addr + 1] << 8)
-
-    # Store instructions
-    elif opcode == 0b0100011:
-        imm_11_5 = (inst >> 25) & 0b1111111
-        imm_4_0 = inst >> 7 & 0b11111
-        imm = (imm_11_5 << 5) | imm_4_0
-        if imm >= (1 << 11):
-            imm -= 1 << 12
-
-        mem_addr = registers[rs1] + imm
-
-        # # SB
-        # if funct3 == 0b000:
-        #     data_memory[mem_addr] = registers[rs2] & 0xFF
-        # # SH
-        # elif funct3 == 0b001:
-        #     data_memory[mem_addr] = registers[rs2] & 0xFF
-        #     data_memory[mem_addr + 1] = (registers[rs2] >> 8) & 0xFF
-        
-        # SW
-        if funct3 == 0b010:
-            if mem_addr == 0x20000000:
-                print(chr(registers[rs2] & 0xFF), end='')
+                jalrs += 1
+        pc = next_pc
+        retired += 1
+
+    model.instructions += retired
+    model.load_use_stalls += load_use
+    model.branches += branches
+    model.taken_branches += taken
+    model.jals += jals
+    model.jalrs += jalrs
+    model.pending_load_rd = pending_load_rd
+    return pc
+########## PIPELINE TIMING MODEL ##########
+
+########## CACHE SIMULATOR ##########
+# Set-associative caches with flat array tag stores: way w of set s lives at..
+# ..index s * assoc + w of the tags/stamps/dirty arrays, -1 marks an empty way
+MEMORY_LATENCY = 100
+CACHE_POLICIES = ("lru", "fifo", "random")
+CACHE_DEFAULTS = {"size": 16384, "assoc": 4, "line": 64, "policy": "lru", "write": "back", "allocate": 1, "hit": 1}
+
+class Cache:
+    def __init__(self, name, size=16384, assoc=4, line=64, policy="lru", write="back", allocate=1, hit=1, next_level=None,
+                 memory_latency=MEMORY_LATENCY):
+        if size < 1 or assoc < 1 or line < 1:
+            raise ValueError(f"{name}: size, assoc and line must be at least 1")
+        if size % (line * assoc):
+            raise ValueError(f"{name}: size must be a multiple of line * assoc")
+        if hit < 0:
+            raise ValueError(f"{name}: hit must not be negative")
+        num_sets = size // (line * assoc)
+        if num_sets & (num_sets - 1) or line & (line - 1):
+            raise ValueError(f"{name}: size / (line * assoc) and line must be powers of two")
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"{name}: policy must be one of {', '.join(CACHE_POLICIES)}")
+        if write not in ("back", "through"):
+            raise ValueError(f"{name}: write must be back or through")
+        self.name = name
+        self.size = size
+        self.assoc = assoc
+        self.line_bits = line.bit_length() - 1
+        self.set_mask = num_sets - 1
+        self.lru = policy == "lru"
+        self.random = random.Random(0) if policy == "random" else None
+        self.write_back = write == "back"
+        self.write_allocate = bool(allocate)
+        self.hit_time = hit
+        self.next_level = next_level
+        self.memory_latency = memory_latency
+
+        self.tags = array("q", [-1]) * (num_sets * assoc)
+        self.stamps = array("Q", [0]) * (num_sets * assoc)
+        self.dirty = bytearray(num_sets * assoc)
+        self.clock = 0
+        self.reads = self.writes = self.read_misses = self.write_misses = self.writebacks = 0
+
+    def access(self, addr, write=False):
+        # Cache addresses are 32-bit, the line number doubles as the tag
+        line = (addr & 0xFFFFFFFF) >> self.line_bits
+        base = (line & self.set_mask) * self.assoc
+        end = base + self.assoc
+        tags = self.tags
+        self.clock += 1
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+
+        try:
+            way = tags.index(line, base, end)
+        except ValueError:
+            way = -1
+        if way >= 0:
+            if self.lru:
+                self.stamps[way] = self.clock
+            if write:
+                if self.write_back:
+                    self.dirty[way] = 1
+                elif self.next_level is not None:
+                    self.next_level.access(addr, True)
+            return True
+
+        if write:
+            self.write_misses += 1
+            if not self.write_allocate:
+                if self.next_level is not None:
+                    self.next_level.access(addr, True)
+                return False
+        else:
+            self.read_misses += 1
+        self.fill(line, base, end, write)
+        return False
+
+    def fill(self, line, base, end, write):
+        tags = self.tags
+        try:
+            way = tags.index(-1, base, end)
+        except ValueError:
+            if self.random is not None:
+                way = base + self.random.randrange(self.assoc)
             else:
-                data_memory[mem_addr] = registers[rs2] & 0xFF
-                data_memory[mem_addr + 1] = (registers[rs2] >> 8) & 0xFF
-                data_memory[mem_addr + 2] = (registers[rs2] >> 16) & 0xFF
-                data_memory[mem_addr + 3] = (registers[rs2] >> 24) & 0xFF
-
-    # ALU instructions
-    elif opcode == 0b0010011:
-        imm = (inst & 0xFFF00000) >> 20
-        shamt = (inst >> 20) & 0x1F
-        imm = sign_extend(imm, 12)
-
-        if rd != 0:
-            # ADDI
-            if funct3 == 0b000:
-                registers[rd] = (registers[rs1] + imm) & 0xFFFFFFFF
-            # SLTI
-            elif funct3 == 0b010:
-                registers[rd] = 1 if registers[rs1] < imm else 0
-            
-            # # SLTIU
-            # elif funct3 == 0b011:
-            #     registers[rd] = 1 if (registers[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0
-            
-            # XORI
-            elif funct3 == 0b100:
-                registers[rd] = registers[rs1] ^ imm
-            # ORI
-            elif funct3 == 0b110:
-                registers[rd] = registers[rs1] | imm
-            # ANDI
-            elif funct3 == 0b111:
-                registers[rd] = registers[rs1] & imm
-            # SLLI
-            elif funct3 == 0b001:
-                registers[rd] = (registers[rs1] & 0xFFFFFFFF) << shamt
-            elif funct3 == 0b101:
-                # SRLI
-                if funct7 == 0b0000000:
-                    registers[rd] = (registers[rs1] & 0xFFFFFFFF) >> shamt
-                # SRAI
-                elif funct7 == 0b0100000:
-                    temp = (registers[rs1] & 0xFFFFFFFF)
-                    shamt = shamt & 0x1F
-                    sign_bit = temp & 0x80000000
-                    if sign_bit:
-                        registers[rd] = (temp >> shamt) | ((0xFFFFFFFF << (32 - shamt)) & 0xFFFFFFFF)
-                    else:
-                        registers[rd] = temp >> shamt
-                    registers[rd] = registers[rd] & 0xFFFFFFFF
-
-    # R-type ALU instructions
-    elif opcode == 0b0110011:
-        if rd != 0:
-            # ADD
-            if funct3 == 0b000 and funct7 == 0b0000000:
-                registers[rd] = registers[rs1] + registers[rs2]
-            # SUB
-            elif funct3 == 0b000 and funct7 == 0b0100000:
-                registers[rd] = registers[rs1] - registers[rs2]
-            # SLL
-            elif funct3 == 0b001 and funct7 == 0b0000000:
-                registers[rd] = registers[rs1] << (registers[rs2] & 0x1F)
-            # SLT
-            elif funct3 == 0b010 and funct7 == 0b0000000:
-                rs1_val = registers[rs1]
-                rs2_val = registers[rs2]
-                if rs1_val & 0x80000000:
-                    rs1_val -= 0x100000000
-                if rs2_val & 0x80000000:
-                    rs2_val -= 0x100000000
-                registers[rd] = 1 if rs1_val < rs2_val else 0
-            
-            # # SLTU
-            # elif funct3 == 0b011 and funct7 == 0b0000000:
-            #     registers[rd] = 1 if registers[rs1] < registers[rs2] else 0
-            
-            # XOR
-            elif funct3 == 0b100 and funct7 == 0b0000000:
-                registers[rd] = registers[rs1] ^ registers[rs2]
-            # SRL
-            elif funct3 == 0b101 and funct7 == 0b0000000:
-                registers[rd] = (registers[rs1] & 0xFFFFFFFF) >> (registers[rs2] & 0x1F)
-            # SRA
-            elif funct3 == 0b101 and funct7 == 0b0100000:
-                registers[rd] = registers[rs1] >> (registers[rs2] & 0x1F)
-            # OR
-            elif funct3 == 0b110 and funct7 == 0b0000000:
-                registers[rd] = registers[rs1] | registers[rs2]
-            # AND
-            elif funct3 == 0b111 and funct7 == 0b0000000:
-                registers[rd] = registers[rs1] & registers[rs2]
-    else:
-        print("unknown instruction")
+                # Oldest stamp: last use for LRU, fill time for FIFO
+                stamps = self.stamps
+                way = min(range(base, end), key=stamps.__getitem__)
+            if self.dirty[way]:
+                self.writebacks += 1
+                if self.next_level is not None:
+                    self.next_level.access(tags[way] << self.line_bits, True)
+        if self.next_level is not None:
+            self.next_level.access(line << self.line_bits, False)
+        tags[way] = line
+        self.stamps[way] = self.clock
+        if write and self.write_back:
+            self.dirty[way] = 1
+        else:
+            if write and self.next_level is not None:
+                self.next_level.access(line << self.line_bits, True)
+            self.dirty[way] = 0
+
+    def misses(self):
+        return self.read_misses + self.write_misses
+
+    def miss_rate(self):
+        accesses = self.reads + self.writes
+        return self.misses() / accesses if accesses else 0.0
+
+    def amat(self):
+        # Average memory access time in cycles, through every level below
+        below = self.memory_latency if self.next_level is None else self.next_level.amat()
+        return self.hit_time + self.miss_rate() * below
+
+    def report(self, file=sys.stderr):
+        accesses = self.reads + self.writes
+        print(f"{self.name}: {self.size} bytes, {self.assoc}-way, {1 << self.line_bits}-byte lines", file=file)
+        print(f"  {accesses} accesses ({self.reads} reads, {self.writes} writes), {self.misses()} misses "
+              f"({self.read_misses} read, {self.write_misses} write), hit rate {1 - self.miss_rate():.2%}", file=file)
+        print(f"  {self.writebacks} writebacks, AMAT {self.amat():.2f} cycles", file=file)
 
-    pc += 4
+def parse_cache_spec(name, spec, next_level=None, memory_latency=MEMORY_LATENCY):
+    # "size=32k,assoc=8,line=64,policy=lru,write=back,allocate=1,hit=1", all optional
+    options = dict(CACHE_DEFAULTS)
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        if key not in options:
+            raise ValueError(f"{name}: unknown cache option {key!r}")
+        if key in ("policy", "write"):
+            options[key] = value
+            continue
+        try:
+            if value[-1:].lower() == "k":
+                options[key] = int(value[:-1]) * 1024
+            else:
+                options[key] = int(value)
+        except ValueError:
+            raise ValueError(f"{name}: {key} must be a number, not {value!r}") from None
+    return Cache(name, next_level=next_level, memory_latency=memory_latency, **options)
+
+class CachedDataMemory(DataMemory):
+    # DataMemory that runs every load and store through a data cache first..
+    # ..the plain DataMemory stays untouched when no cache is configured
+    def __init__(self, data_memory, dcache):
+        super().__init__(data_memory.console)
+        self.pages = data_memory.pages
+        self.dcache = dcache
+
+    def load_word(self, addr):
+        self.dcache.access(addr)
+        return super().load_word(addr)
+
+    def store_word(self, addr, value):
+        self.dcache.access(addr, True)
+        super().store_word(addr, value)
+
+    def load_half(self, addr):
+        self.dcache.access(addr)
+        return super().load_half(addr)
+
+    def store_half(self, addr, value):
+        self.dcache.access(addr, True)
+        super().store_half(addr, value)
+
+    def load_byte(self, addr):
+        self.dcache.access(addr)
+        return super().load_byte(addr)
+
+    def store_byte(self, addr, value):
+        self.dcache.access(addr, True)
+        super().store_byte(addr, value)
+
+class CachedFetch:
+    # Stands in for the decoded program and sends every fetch through the icache
+    def __init__(self, decoded, icache):
+        self.decoded = decoded
+        self.icache = icache
+
+    def __getitem__(self, i):
+        self.icache.access(i << 2)
+        return self.decoded[i]
+
+    def __len__(self):
+        return len(self.decoded)
+########## CACHE SIMULATOR ##########
+
+########## BRANCH PREDICTION ##########
+# Direction predictors index flat bytearray tables by the branch pc, the BTB..
+# ..keeps tags and targets in parallel arrays
+BRANCH_HANDLERS = (exec_beq, exec_bne, exec_blt, exec_bge, exec_bltu, exec_bgeu)
+PREDICTOR_ENTRIES = 1024
+
+class StaticPredictor:
+    # Always predicts not taken
+    def __init__(self, entries=PREDICTOR_ENTRIES):
+        pass
+
+    def predict(self, pc):
+        return False
+
+    def update(self, pc, taken):
+        pass
+
+class OneBitPredictor:
+    # Predicts whatever the branch did last time
+    def __init__(self, entries=PREDICTOR_ENTRIES):
+        self.mask = entries - 1
+        self.table = bytearray(entries)
+
+    def predict(self, pc):
+        return self.table[(pc >> 2) & self.mask] == 1
+
+    def update(self, pc, taken):
+        self.table[(pc >> 2) & self.mask] = taken
+
+class TwoBitPredictor:
+    # 2-bit saturating counters, 0-1 predict not taken, 2-3 taken
+    def __init__(self, entries=PREDICTOR_ENTRIES):
+        self.mask = entries - 1
+        self.counters = bytearray([1]) * entries
+
+    def index(self, pc):
+        return (pc >> 2) & self.mask
+
+    def predict(self, pc):
+        return self.counters[self.index(pc)] >= 2
+
+    def update(self, pc, taken):
+        i = self.index(pc)
+        counter = self.counters[i]
+        if taken:
+            if counter < 3:
+                self.counters[i] = counter + 1
+        elif counter > 0:
+            self.counters[i] = counter - 1
+
+class GsharePredictor(TwoBitPredictor):
+    # 2-bit counters indexed by the pc xor'd with the global branch history
+    def __init__(self, entries=PREDICTOR_ENTRIES):
+        super().__init__(entries)
+        self.history = 0
+
+    def index(self, pc):
+        return ((pc >> 2) ^ self.history) & self.mask
+
+    def update(self, pc, taken):
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.mask
+
+PREDICTORS = {
+    "static": StaticPredictor,
+    "1bit": OneBitPredictor,
+    "2bit": TwoBitPredictor,
+    "gshare": GsharePredictor,
+}
+
+class BranchTargetBuffer:
+    # Direct-mapped pc -> taken target cache
+    def __init__(self, entries=256):
+        self.mask = entries - 1
+        self.tags = array("q", [-1]) * entries
+        self.targets = array("q", [0]) * entries
+
+    def lookup(self, pc):
+        i = (pc >> 2) & self.mask
+        return self.targets[i] if self.tags[i] == (pc & 0xFFFFFFFF) else None
+
+    def update(self, pc, target):
+        i = (pc >> 2) & self.mask
+        self.tags[i] = pc & 0xFFFFFFFF
+        self.targets[i] = target & 0xFFFFFFFF
+
+class BranchUnit:
+    # Checks every resolved conditional branch against the predictor (and..
+    # ..BTB), it's hooked in like a plugin with just a branch hook
+    def __init__(self, predictor, btb=None):
+        self.predictor = predictor
+        self.btb = btb
+        self.counts = defaultdict(int)
+        self.mispredicts = defaultdict(int)
+        self.btb_misses = 0
+
+    def on_branch(self, pc, taken, next_pc):
+        predicted = self.predictor.predict(pc)
+        correct = predicted == taken
+        if self.btb is not None and taken:
+            # A taken prediction only helps if the BTB also has the right target
+            if predicted and self.btb.lookup(pc) != (next_pc & 0xFFFFFFFF):
+                self.btb_misses += 1
+                correct = False
+            self.btb.update(pc, next_pc)
+        self.predictor.update(pc, taken)
+        self.counts[pc] += 1
+        if not correct:
+            self.mispredicts[pc] += 1
+
+    def total_mispredicts(self):
+        return sum(self.mispredicts.values())
+
+    def report(self, instructions, top=10, cache_size=DISASSEMBLY_CACHE_SIZE, cache_stats=False, file=sys.stderr):
+        total = sum(self.counts.values())
+        wrong = self.total_mispredicts()
+        rate = wrong / total if total else 0.0
+        name = type(self.predictor).__name__
+        print(f"branches: {total} resolved, {wrong} mispredicted ({rate:.2%}) by {name}", file=file)
+        if self.btb is not None:
+            print(f"  {self.btb_misses} taken predictions missed in the BTB", file=file)
+        disassemble = make_disassembly_cache(cache_size)
+        worst = sorted(self.counts, key=lambda pc: (self.mispredicts[pc], self.counts[pc]), reverse=True)[:top]
+        for pc in worst:
+            count = self.counts[pc]
+            print(f"  {pc:#010x} {count:>10} {self.mispredicts[pc] / count:7.2%}  {disassemble(instructions[pc // 4])}", file=file)
+        if cache_stats:
+            report_disassembly_cache(disassemble, file=file)
+########## BRANCH PREDICTION ##########
+
+########## EXECUTION TRACE ##########
+# One fixed-width little-endian record per retired instruction: pc, the..
+# ..instruction word, rd, flags, the value written to rd and the memory..
+# ..address/value of a load or store, all as 32-bit words
+TRACE_MAGIC = b"RVTRACE1"
+TRACE_HEADER = struct.Struct("<8sI") # magic, record size
+TRACE_RECORD = struct.Struct("<IIBBxxIII")
+TRACE_BUFFER_RECORDS = 1 << 14
+TRACE_WRITES_RD = 1
+TRACE_LOAD = 2
+TRACE_STORE = 4
+TRACE_COMPRESSIONS = ("gzip", "zstd")
+
+TRACE_CLASSES = {
+    exec_lui: TRACE_WRITES_RD, exec_auipc: TRACE_WRITES_RD,
+    exec_jal: TRACE_WRITES_RD, exec_jalr: TRACE_WRITES_RD,
+    exec_beq: 0, exec_bne: 0, exec_blt: 0, exec_bge: 0, exec_bltu: 0, exec_bgeu: 0,
+    exec_lw: TRACE_WRITES_RD | TRACE_LOAD, exec_lb: TRACE_WRITES_RD | TRACE_LOAD,
+    exec_lh: TRACE_WRITES_RD | TRACE_LOAD, exec_lbu: TRACE_WRITES_RD | TRACE_LOAD,
+    exec_lhu: TRACE_WRITES_RD | TRACE_LOAD,
+    exec_sw: TRACE_STORE, exec_sb: TRACE_STORE, exec_sh: TRACE_STORE,
+    exec_addi: TRACE_WRITES_RD, exec_slti: TRACE_WRITES_RD, exec_sltiu: TRACE_WRITES_RD,
+    exec_xori: TRACE_WRITES_RD,
+    exec_ori: TRACE_WRITES_RD, exec_andi: TRACE_WRITES_RD, exec_slli: TRACE_WRITES_RD,
+    exec_srli: TRACE_WRITES_RD, exec_srai: TRACE_WRITES_RD,
+    exec_add: TRACE_WRITES_RD, exec_sub: TRACE_WRITES_RD, exec_sll: TRACE_WRITES_RD,
+    exec_slt: TRACE_WRITES_RD, exec_sltu: TRACE_WRITES_RD, exec_xor: TRACE_WRITES_RD,
+    exec_srl: TRACE_WRITES_RD, exec_sra: TRACE_WRITES_RD, exec_or: TRACE_WRITES_RD,
+    exec_and: TRACE_WRITES_RD,
+    exec_mul: TRACE_WRITES_RD, exec_mulh: TRACE_WRITES_RD, exec_mulhsu: TRACE_WRITES_RD,
+    exec_mulhu: TRACE_WRITES_RD, exec_div: TRACE_WRITES_RD, exec_divu: TRACE_WRITES_RD,
+    exec_rem: TRACE_WRITES_RD, exec_remu: TRACE_WRITES_RD,
+    exec_nop: 0, exec_unknown: 0,
+}
+# Bits of rs2 a store writes, the trace records the value as it lands in memory
+TRACE_STORE_MASKS = {exec_sw: 0xFFFFFFFF, exec_sh: 0xFFFF, exec_sb: 0xFF}
+
+class TraceWriter:
+    # Packs records into a preallocated buffer and writes it out a chunk at..
+    # ..a time, optionally through gzip or zstd
+    def __init__(self, file_name, compression=None):
+        self.file = open(file_name, "wb")
+        self.stream = self.file
+        if compression == "gzip":
+            self.stream = gzip.GzipFile(fileobj=self.file, mode="wb", compresslevel=1)
+        elif compression == "zstd":
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file)
+        self.stream.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_RECORD.size))
+        self.classes = HandlerTable(TRACE_CLASSES)
+        self.buffer = bytearray(TRACE_RECORD.size * TRACE_BUFFER_RECORDS)
+        self.offset = 0
+        self.records = 0
+
+    def write_buffer(self, end):
+        self.stream.write(memoryview(self.buffer)[:end])
+        self.records += end // TRACE_RECORD.size
+
+    def close(self):
+        self.write_buffer(self.offset)
+        self.offset = 0
+        if self.stream is not self.file:
+            self.stream.close()
+        self.file.close()
+
+def run_traced(decoded, registers, data_memory, num_instructions, pc, instructions, trace):
+    # run_program() plus one trace record per step, the load/store address..
+    # ..is taken before the handler runs since it may overwrite rs1
+    program_end = len(decoded) * 4
+    classes = trace.classes
+    store_masks = TRACE_STORE_MASKS
+    buffer = trace.buffer
+    buffer_end = len(buffer)
+    offset = trace.offset
+    pack_into = TRACE_RECORD.pack_into
+    record_size = TRACE_RECORD.size
+    for _ in range(num_instructions):
+        if pc >= program_end:
+            break
+        handler, rd, rs1, rs2, imm = decoded[pc // 4]
+        flags = classes[handler]
+        addr = value = rd_value = 0
+        if flags & TRACE_STORE:
+            addr = registers[rs1] + imm
+            value = registers[rs2] & store_masks[handler]
+        elif flags & TRACE_LOAD:
+            addr = registers[rs1] + imm
+        next_pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+        if flags & TRACE_WRITES_RD:
+            rd_value = registers[rd]
+            if flags & TRACE_LOAD:
+                value = rd_value
+        pack_into(buffer, offset, pc & 0xFFFFFFFF, instructions[pc // 4], rd & 0b11111, flags,
+                  rd_value, addr & 0xFFFFFFFF, value)
+        offset += record_size
+        if offset == buffer_end:
+            trace.write_buffer(offset)
+            offset = 0
+        pc = next_pc
+    trace.offset = offset
     return pc
-########## MAIN FUNCTIONS ##########
+
+def open_trace(file_name):
+    # Opens a trace for reading, gzip and zstd streams are told apart by..
+    # ..their magic bytes
+    with open(file_name, "rb") as file:
+        magic = file.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(file_name, "rb")
+    if magic == b"\x28\xb5\x2f\xfd":
+        if zstandard is None:
+            raise ValueError(f"{file_name}: reading a zstd trace needs the zstandard module")
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"))
+    return open(file_name, "rb")
+
+def read_trace(file_name, start=None, end=None):
+    # Yields (step, pc, inst, rd, flags, rd_value, addr, value) for every..
+    # ..record, or only those with start <= pc < end
+    with open_trace(file_name) as stream:
+        magic, record_size = TRACE_HEADER.unpack(stream.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC or record_size != TRACE_RECORD.size:
+            raise ValueError(f"{file_name}: not an execution trace")
+        chunk_size = record_size * TRACE_BUFFER_RECORDS
+        low = 0 if start is None else start
+        high = 1 << 32 if end is None else end
+        step = 0
+        leftover = b""
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            chunk = leftover + chunk
+            usable = len(chunk) - len(chunk) % record_size
+            leftover = chunk[usable:]
+            for record in TRACE_RECORD.iter_unpack(memoryview(chunk)[:usable]):
+                if low <= record[0] < high:
+                    yield (step,) + record
+                step += 1
+
+def print_trace(file_name, start=None, end=None, limit=None, cache_size=DISASSEMBLY_CACHE_SIZE, cache_stats=False,
+                file=sys.stdout):
+    disassemble = make_disassembly_cache(cache_size)
+    for count, (step, pc, inst, rd, flags, rd_value, addr, value) in enumerate(read_trace(file_name, start, end)):
+        if limit is not None and count >= limit:
+            break
+        line = f"{step:>10} {pc:#010x} {inst:08x}  {disassemble(inst):<24}"
+        if flags & TRACE_WRITES_RD and rd != 0:
+            line += f" x{rd}={rd_value:#010x}"
+        if flags & (TRACE_LOAD | TRACE_STORE):
+            where = "console" if addr == CONSOLE_ADDRESS else f"{addr:#010x}"
+            line += f" {'load' if flags & TRACE_LOAD else 'store'} [{where}]={value:#010x}"
+        print(line.rstrip(), file=file)
+    if cache_stats:
+        file.flush()
+        report_disassembly_cache(disassemble)
+########## EXECUTION TRACE ##########
+
+########## PLUGINS ##########
+# Instrumentation hooks for code outside the simulator. A plugin is any..
+# ..object with some of these methods, each hook that's None or missing..
+# ..costs nothing:
+#   on_retire(pc, next_pc)              after every instruction
+#   on_branch(pc, taken, next_pc)       after every conditional branch
+#   on_memory_read(addr, size, value)   loads from data memory
+#   on_memory_write(addr, size, value)  stores to data memory
+#   on_mmio(addr, write, value)         console reads and writes
+# Retire and branch hooks wrap handlers in the fetch layer, so blocks..
+# ..aren't translated or fused while one is registered (main() warns when..
+# ..that overrides --translate or --fuse). Memory and MMIO hooks wrap the..
+# ..data memory and console and work with every run loop
+class Plugin:
+    on_retire = None
+    on_branch = None
+    on_memory_read = None
+    on_memory_write = None
+    on_mmio = None
+
+    def report(self, file=sys.stderr):
+        pass
+
+def combine_hooks(hooks):
+    # One callable for a list of hooks, the hook itself when there's just one
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+    def call_hooks(*args):
+        for hook in hooks:
+            hook(*args)
+    return call_hooks
+
+def make_hooked_handler(handler, retire, branch):
+    # Wraps handler to report to the retire hook and, for conditional..
+    # ..branches, the branch hook. Either may be None
+    if branch is None or handler not in BRANCH_HANDLERS:
+        if retire is None:
+            return handler
+        @functools.wraps(handler)
+        def retired(registers, data_memory, pc, rd, rs1, rs2, imm):
+            next_pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+            retire(pc, next_pc)
+            return next_pc
+        return retired
+    if retire is None:
+        @functools.wraps(handler)
+        def resolved(registers, data_memory, pc, rd, rs1, rs2, imm):
+            next_pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+            branch(pc, next_pc != pc + 4, next_pc)
+            return next_pc
+        return resolved
+    @functools.wraps(handler)
+    def resolved_and_retired(registers, data_memory, pc, rd, rs1, rs2, imm):
+        next_pc = handler(registers, data_memory, pc, rd, rs1, rs2, imm)
+        branch(pc, next_pc != pc + 4, next_pc)
+        retire(pc, next_pc)
+        return next_pc
+    return resolved_and_retired
+
+class HookedProgram(dict):
+    # Decoded records with handlers swapped for ones that call the hooks,..
+    # ..with only a branch hook the other handlers stay as they are
+    def __init__(self, decoded, retire, branch):
+        super().__init__()
+        self.decoded = decoded
+        self.retire = retire
+        self.branch = branch
+        self.handlers = {}
+
+    def __missing__(self, i):
+        record = self.decoded[i]
+        handler = self.handlers.get(record[0])
+        if handler is None:
+            handler = self.handlers[record[0]] = make_hooked_handler(record[0], self.retire, self.branch)
+        record = self[i] = (handler,) + record[1:]
+        return record
+
+    def __len__(self):
+        return len(self.decoded)
+
+class HookedDataMemory(DataMemory):
+    # Runs loads and stores through the memory below (plain or cached) and..
+    # ..reports them to the read and write hooks
+    def __init__(self, data_memory, read, write):
+        super().__init__(data_memory.console)
+        self.pages = data_memory.pages
+        self.memory = data_memory
+        self.read = read
+        self.write = write
+
+    def load_word(self, addr):
+        value = self.memory.load_word(addr)
+        if self.read is not None:
+            self.read(addr, 4, value)
+        return value
+
+    def load_half(self, addr):
+        value = self.memory.load_half(addr)
+        if self.read is not None:
+            self.read(addr, 2, value)
+        return value
+
+    def load_byte(self, addr):
+        value = self.memory.load_byte(addr)
+        if self.read is not None:
+            self.read(addr, 1, value)
+        return value
+
+    def store_word(self, addr, value):
+        self.memory.store_word(addr, value)
+        if self.write is not None:
+            self.write(addr, 4, value & 0xFFFFFFFF)
+
+    def store_half(self, addr, value):
+        self.memory.store_half(addr, value)
+        if self.write is not None:
+            self.write(addr, 2, value & 0xFFFF)
+
+    def store_byte(self, addr, value):
+        self.memory.store_byte(addr, value)
+        if self.write is not None:
+            self.write(addr, 1, value & 0xFF)
+
+class HookedConsole:
+    # Stands in for the console and reports every access to the MMIO hook
+    def __init__(self, console, mmio):
+        self.console = console
+        self.mmio = mmio
+
+    def write_char(self, value):
+        self.mmio(CONSOLE_ADDRESS, True, value & 0xFF)
+        self.console.write_char(value)
+
+    def read_int(self):
+        value = self.console.read_int()
+        self.mmio(CONSOLE_ADDRESS, False, value & 0xFFFFFFFF)
+        return value
+
+    def flush(self):
+        self.console.flush()
+
+def load_plugin(file_name, machine):
+    # A plugin file is a Python file with a register(machine) function that..
+    # ..calls machine.add_plugin() for each plugin it sets up
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(file_name))[0], file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.register(machine)
+########## PLUGINS ##########
+
+########## MACHINE ##########
+RUN_SLICE_STEPS = 100000
+
+class Machine:
+    # Architectural state of one simulated program: pc, registers, data memory
+    # Machines running the same program may share its decoded records and..
+    # ..translated blocks, neither depends on the machine state
+    def __init__(self, instructions, data_contents=b"", console=None, decoded=None, blocks=None):
+        self.instructions = instructions
+        self.decoded = decode_program(instructions) if decoded is None else decoded
+        # What the run loops fetch records from, see update_fetch()
+        self.fetch = self.decoded
+        self.program_end = len(self.decoded) * 4
+        self.registers = make_registers()
+        # What the handlers load from and store to, see update_memory()
+        self.memory = self.data_memory = DataMemory(console)
+        self.console = self.memory.console
+        self.memory.load(DATA_MEMORY_START, data_contents)
+        self.pc = 0
+        self.blocks = {} if blocks is None else blocks
+        self.profiler = None
+        self.pipeline = None
+        self.caches = []
+        self.icache = None
+        self.dcache = None
+        self.branch_unit = None
+        self.trace = None
+        self.fused = None
+        self.plugins = []
+
+    def run(self, num_instructions, translate=False, deadline=None):
+        # Run up to num_instructions, in slices when there's a deadline..
+        # ..(a time.monotonic() value), returns False if it ran out of time
+        if deadline is None:
+            self.run_steps(num_instructions, translate)
+            return True
+        remaining = num_instructions
+        while remaining > 0 and self.pc < self.program_end:
+            if time.monotonic() > deadline:
+                return False
+            steps = min(remaining, RUN_SLICE_STEPS)
+            self.run_steps(steps, translate)
+            remaining -= steps
+        return True
+
+    def run_steps(self, num_instructions, translate=False):
+        if self.profiler is not None:
+            # Profiling needs every step, so it always interprets
+            self.pc = run_profiled(self.fetch, self.registers, self.data_memory, num_instructions, self.pc, self.profiler)
+        elif self.pipeline is not None:
+            self.pc = run_timed(self.fetch, self.registers, self.data_memory, num_instructions, self.pc, self.pipeline)
+        elif self.trace is not None:
+            self.pc = run_traced(self.fetch, self.registers, self.data_memory, num_instructions, self.pc, self.instructions, self.trace)
+        elif translate and self.fetch is self.decoded:
+            # Translated blocks don't fetch per instruction, so not with an icache
+            self.pc = run_translated(self.decoded, self.registers, self.data_memory, num_instructions, self.pc, self.blocks)
+        elif self.fused is not None and self.fetch is self.decoded:
+            self.pc = run_fused(self.fused, self.registers, self.data_memory, num_instructions, self.pc)
+        else:
+            self.pc = run_program(self.fetch, self.registers, self.data_memory, num_instructions, self.pc)
+
+    def fast_forward(self, num_instructions):
+        # Run on the translated blocks straight out of the decoded program,..
+        # ..bypassing the fetch layers so nothing attached sees these steps
+        self.pc = run_translated(self.decoded, self.registers, self.data_memory, num_instructions, self.pc, self.blocks)
+
+    def enable_fusion(self):
+        self.fused = FusedProgram(self.decoded)
+
+    def attach_caches(self, dcache=None, icache=None):
+        self.dcache = dcache
+        self.icache = icache
+        self.update_memory()
+        self.update_fetch()
+        # Report each level once, L1s first
+        level = [cache for cache in (icache, dcache) if cache is not None]
+        while level:
+            below = []
+            for cache in level:
+                if cache not in self.caches:
+                    self.caches.append(cache)
+                if cache.next_level is not None:
+                    below.append(cache.next_level)
+            level = below
+
+    def attach_pipeline(self, pipeline):
+        self.pipeline = pipeline
+        self.update_fetch()
+
+    def attach_branch_predictor(self, branch_unit):
+        self.branch_unit = branch_unit
+        self.update_fetch()
+
+    def attach_trace(self, trace):
+        self.trace = trace
+        self.update_fetch()
+
+    def add_plugin(self, plugin):
+        self.plugins.append(plugin)
+        self.update_memory()
+        self.update_fetch()
+
+    def hooks(self, name):
+        # The branch unit is hooked in ahead of the plugins
+        sources = [self.branch_unit] + self.plugins if self.branch_unit is not None else self.plugins
+        return combine_hooks([hook for hook in (getattr(source, name, None) for source in sources) if hook is not None])
+
+    def update_fetch(self):
+        # Layer the record source: decoded program, retire/branch hooks, icache
+        fetch = self.decoded
+        if self.pipeline is not None:
+            self.pipeline.branch_unit = self.branch_unit
+        retire = self.hooks("on_retire")
+        branch = self.hooks("on_branch")
+        if retire is not None or branch is not None:
+            fetch = HookedProgram(fetch, retire, branch)
+        if self.icache is not None:
+            fetch = CachedFetch(fetch, self.icache)
+        self.fetch = fetch
+
+    def update_memory(self):
+        # Layer the data memory the same way: pages, dcache, memory hooks,..
+        # ..and put the MMIO hook in front of the console
+        memory = self.memory
+        if self.dcache is not None:
+            memory = CachedDataMemory(memory, self.dcache)
+        read = self.hooks("on_memory_read")
+        write = self.hooks("on_memory_write")
+        if read is not None or write is not None:
+            memory = HookedDataMemory(memory, read, write)
+        mmio = self.hooks("on_mmio")
+        memory.console = self.console if mmio is None else HookedConsole(self.console, mmio)
+        self.data_memory = memory
+
+    def register_dump(self):
+        return register_dump(self.registers)
+
+    def save_snapshot(self, file_name):
+        self.console.flush()
+        save_snapshot(self, file_name)
+
+    def load_snapshot(self, file_name):
+        load_snapshot(self, file_name)
+########## MACHINE ##########
+
+########## SNAPSHOTS ##########
+# Snapshot file layout (little-endian):
+#   magic, program checksum (u32), program length in words (u64)
+#   pc as a length-prefixed signed integer, then x0..x31 as u32 words
+#   page count (u64), then per page its number and PAGE_SIZE raw bytes
+# Only allocated pages are stored, so a sparse memory stays small
+SNAPSHOT_MAGIC = b"RVSNAP02"
+SNAPSHOT_HEADER = struct.Struct("<8sIQ")
+SNAPSHOT_REGISTERS = struct.Struct(f"<{NUM_REGISTERS}I")
+SNAPSHOT_COUNT = struct.Struct("<Q")
+SNAPSHOT_INT_LENGTH = struct.Struct("<H")
+
+def program_checksum(instructions):
+    if isinstance(instructions, InstructionStream):
+        checksum = zlib.crc32(instructions.words)
+        if instructions.tail is not None:
+            checksum = zlib.crc32(WORD.pack(instructions.tail), checksum)
+        return checksum
+    return zlib.crc32(b"".join(WORD.pack(inst) for inst in instructions))
+
+def pack_int(value):
+    # The pc and page numbers aren't bounded to 32 bits, so store any int
+    length = (value.bit_length() + 8) // 8
+    return SNAPSHOT_INT_LENGTH.pack(length) + value.to_bytes(length, "little", signed=True)
+
+def unpack_int(view, offset):
+    (length,) = SNAPSHOT_INT_LENGTH.unpack_from(view, offset)
+    offset += SNAPSHOT_INT_LENGTH.size
+    return int.from_bytes(view[offset:offset + length], "little", signed=True), offset + length
+
+def save_snapshot(machine, file_name):
+    pages = machine.data_memory.pages
+    with open(file_name, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, program_checksum(machine.instructions), len(machine.instructions)))
+        f.write(pack_int(machine.pc))
+        f.write(SNAPSHOT_REGISTERS.pack(*machine.registers[:NUM_REGISTERS]))
+        # Pages that were written back to all 0xFF look the same as unallocated ones
+        stored = [number for number, page in pages.items() if page != EMPTY_PAGE]
+        f.write(SNAPSHOT_COUNT.pack(len(stored)))
+        for number in stored:
+            f.write(pack_int(number))
+            f.write(pages[number])
+
+def load_snapshot(machine, file_name):
+    with open(file_name, "rb") as f:
+        view = memoryview(f.read())
+    magic, checksum, num_words = SNAPSHOT_HEADER.unpack_from(view, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{file_name} is not a snapshot file")
+    if checksum != program_checksum(machine.instructions) or num_words != len(machine.instructions):
+        raise ValueError(f"{file_name} was taken from a different program")
+
+    offset = SNAPSHOT_HEADER.size
+    machine.pc, offset = unpack_int(view, offset)
+    machine.registers[:NUM_REGISTERS] = SNAPSHOT_REGISTERS.unpack_from(view, offset)
+    offset += SNAPSHOT_REGISTERS.size
+    machine.registers[0] = 0
+    (num_pages,) = SNAPSHOT_COUNT.unpack_from(view, offset)
+    offset += SNAPSHOT_COUNT.size
+    pages = {}
+    for _ in range(num_pages):
+        number, offset = unpack_int(view, offset)
+        pages[number] = bytearray(view[offset:offset + PAGE_SIZE])
+        offset += PAGE_SIZE
+    machine.memory.pages = pages
+    machine.update_memory()
+########## SNAPSHOTS ##########
+
+########## BATCH RUNNER ##########
+# Runs a manifest of jobs, one JSON object per line:
+#   {"id": ..., "instructions": path, "data": path, "steps": N, "stdin": text}
+# and writes one JSON result per line with the register dump and console output
+def read_manifest(manifest_file):
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    with open(manifest_file) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job.setdefault("id", line_number)
+            # Paths in the manifest are relative to the manifest itself
+            for key in ("instructions", "data"):
+                if job.get(key):
+                    job[key] = os.path.join(base, job[key])
+            jobs.append(job)
+    return jobs
+
+def run_job(job, translate=False, timeout=None):
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    result = {"id": job["id"]}
+    output = io.StringIO()
+    console = Console(output, io.StringIO(job.get("stdin", "")))
+    try:
+        # Stray prints like "unknown instruction" land in the same output
+        with contextlib.redirect_stdout(output):
+            data_contents = read_file(job["data"]) if job.get("data") else b""
+            machine = Machine(load_instructions(job["instructions"]), data_contents, console)
+            finished = machine.run(int(job["steps"]), translate, deadline)
+        result["status"] = "ok" if finished else "timeout"
+        result["registers"] = machine.register_dump()
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        console.flush()
+    result["console"] = output.getvalue()
+    result["elapsed"] = round(time.monotonic() - start, 6)
+    return result
+
+def run_batch(manifest_file, output_file, jobs=None, translate=False, timeout=None):
+    manifest = read_manifest(manifest_file)
+    with ProcessPoolExecutor(max_workers=jobs) as executor, open(output_file, "w") as out:
+        futures = [executor.submit(run_job, job, translate, timeout) for job in manifest]
+        for future in futures:
+            out.write(json.dumps(future.result()) + "\n")
+########## BATCH RUNNER ##########
+
+########## SIMULATION SERVER ##########
+# Long-lived server for running many jobs without paying interpreter startup..
+# ..and decoding each time. Clients send jobs as JSON lines, like the --batch..
+# ..manifest but with absolute paths, or the files inline as base64:
+#   {"id": ..., "instructions": path, "data": path, "steps": N, "stdin": text, "translate": bool}
+#   {"id": ..., "instructions_base64": ..., "data_base64": ..., "steps": N}
+# Console output streams back as {"id": ..., "console": text} lines while the..
+# ..job runs, then a final line like a --batch result without "console"
+# Clients keep the connection open until their results are in, closing it..
+# ..cancels every job of that connection still queued or running
+SERVER_PROGRAM_CACHE_SIZE = 64
+# Longest job line accepted, inline binaries are base64 so this allows..
+# ..programs of up to about 48 MB
+SERVER_LINE_LIMIT = 64 << 20
+
+def read_job_file(job, key):
+    if job.get(key):
+        return read_file(job[key])
+    if job.get(key + "_base64"):
+        return base64.b64decode(job[key + "_base64"])
+    return b""
+
+def cached_program(programs, contents):
+    # Worker-side LRU of (instructions, decoded records, translated blocks)..
+    # ..keyed by the binary's hash, so repeated programs skip decoding
+    key = hashlib.sha256(contents).hexdigest()
+    program = programs.get(key)
+    if program is None:
+        instructions = get_instructions(contents)
+        program = programs[key] = (instructions, decode_program(instructions), {})
+        if len(programs) > SERVER_PROGRAM_CACHE_SIZE:
+            programs.popitem(last=False)
+    else:
+        programs.move_to_end(key)
+    return program
+
+class ServerJob:
+    # One job inside a worker, run RUN_SLICE_STEPS at a time
+    def __init__(self, job, programs, translate=False, timeout=None):
+        self.job = job
+        self.programs = programs
+        self.translate = job.get("translate", translate)
+        self.start = time.monotonic()
+        self.deadline = None if timeout is None else self.start + timeout
+        self.output = io.StringIO()
+        self.console = Console(self.output, io.StringIO(job.get("stdin", "")))
+        self.machine = None
+        self.remaining = 0
+
+    def run_slice(self):
+        # Returns the result once the job is over, None while it has steps left
+        result = {"id": self.job.get("id")}
+        try:
+            with contextlib.redirect_stdout(self.output):
+                if self.machine is None:
+                    instructions, decoded, blocks = cached_program(self.programs, read_job_file(self.job, "instructions"))
+                    self.machine = Machine(instructions, read_job_file(self.job, "data"), self.console, decoded, blocks)
+                    self.remaining = int(self.job["steps"])
+                steps = min(self.remaining, RUN_SLICE_STEPS)
+                self.machine.run_steps(steps, self.translate)
+                self.remaining -= steps
+            if self.remaining > 0 and self.machine.pc < self.machine.program_end:
+                if self.deadline is None or time.monotonic() <= self.deadline:
+                    return None
+                result["status"] = "timeout"
+            else:
+                result["status"] = "ok"
+            result["registers"] = self.machine.register_dump()
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["elapsed"] = round(time.monotonic() - self.start, 6)
+        return result
+
+    def take_output(self):
+        self.console.flush()
+        text = self.output.getvalue()
+        if text:
+            self.output.seek(0)
+            self.output.truncate()
+        return text
+
+def serve_worker(connection, translate=False, timeout=None):
+    # Worker process loop: takes ("run", number, job) and ("cancel", number, None)..
+    # ..messages and gives every live job a slice in turn, so one long run..
+    # ..can't starve the short ones. Replies are ("console", number, text)..
+    # ..and ("done", number, result), with no result for a cancelled job
+    programs = OrderedDict()
+    jobs = {}
+    while True:
+        # Block for messages only when there's nothing to run
+        while not jobs or connection.poll():
+            try:
+                message = connection.recv()
+            except EOFError:
+                return
+            if message is None:
+                return
+            kind, number, job = message
+            if kind == "run":
+                jobs[number] = ServerJob(job, programs, translate, timeout)
+            elif jobs.pop(number, None) is not None:
+                connection.send(("done", number, None))
+        for number in list(jobs):
+            job = jobs[number]
+            result = job.run_slice()
+            text = job.take_output()
+            if text:
+                connection.send(("console", number, text))
+            if result is not None:
+                del jobs[number]
+                connection.send(("done", number, result))
+
+def feed_worker(connection, outbox):
+    # Sender thread of one worker, passes its queued messages down the pipe..
+    # ..in order until the None that stops the worker
+    while True:
+        message = outbox.get()
+        try:
+            connection.send(message)
+        except (BrokenPipeError, OSError):
+            return
+        if message is None:
+            return
+
+class ServerClient:
+    # One client connection and the numbers of its jobs still running
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = set()
+        self.closed = False
+
+class SimulationServer:
+    def __init__(self, workers=None, translate=False, timeout=None):
+        self.num_workers = workers or os.cpu_count() or 1
+        self.translate = translate
+        self.timeout = timeout
+        self.connections = []
+        self.processes = []
+        # Messages to each worker go through a queue and a sender thread, a..
+        # ..big inline job blocking on a full pipe must not stall the event loop
+        self.outboxes = []
+        self.senders = []
+        self.load = [0] * self.num_workers
+        # job number -> (client, job id, worker index)
+        self.jobs = {}
+        self.next_number = 0
+
+    def start_workers(self):
+        for _ in range(self.num_workers):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_worker, args=(child, self.translate, self.timeout), daemon=True)
+            process.start()
+            child.close()
+            outbox = queue.SimpleQueue()
+            sender = threading.Thread(target=feed_worker, args=(connection, outbox), daemon=True)
+            sender.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self.outboxes.append(outbox)
+            self.senders.append(sender)
+
+    def stop_workers(self):
+        for outbox in self.outboxes:
+            outbox.put(None)
+        for sender in self.senders:
+            sender.join(1)
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+    def submit(self, client, job):
+        # Least loaded worker, ties go to the one the job's hash prefers..
+        # ..so repeats of a program tend to hit the same program cache
+        preferred = hash(job.get("instructions") or job.get("instructions_base64")) % self.num_workers
+        worker = min(range(self.num_workers), key=lambda i: (self.load[i], i != preferred))
+        number = self.next_number
+        self.next_number += 1
+        self.jobs[number] = (client, job.get("id"), worker)
+        self.load[worker] += 1
+        client.pending.add(number)
+        self.outboxes[worker].put(("run", number, job))
+
+    def cancel(self, client):
+        for number in client.pending:
+            self.outboxes[self.jobs[number][2]].put(("cancel", number, None))
+
+    async def send(self, client, message):
+        if client.closed:
+            return
+        try:
+            client.writer.write((json.dumps(message) + "\n").encode())
+            await client.writer.drain()
+        except ConnectionError:
+            client.closed = True
+            self.cancel(client)
+
+    async def forward(self, worker, executor):
+        # Relays one worker's replies to the clients that sent the jobs
+        loop = asyncio.get_running_loop()
+        connection = self.connections[worker]
+        while True:
+            try:
+                kind, number, payload = await loop.run_in_executor(executor, connection.recv)
+            except (EOFError, OSError):
+                return
+            client, job_id, _ = self.jobs[number]
+            if kind == "done":
+                del self.jobs[number]
+                self.load[worker] -= 1
+                client.pending.discard(number)
+                if payload is not None:
+                    await self.send(client, payload)
+            elif number in client.pending:
+                await self.send(client, {"id": job_id, "console": payload})
+
+    async def handle_client(self, reader, writer):
+        client = ServerClient(writer)
+        try:
+            while not client.closed:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Past SERVER_LINE_LIMIT, the rest of the line can't be told apart from the next job
+                    await self.send(client, {"id": None, "status": "error",
+                                             "error": f"bad job: longer than {SERVER_LINE_LIMIT} bytes"})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    await self.send(client, {"id": None, "status": "error", "error": f"bad job: {e}"})
+                    continue
+                if not isinstance(job, dict):
+                    await self.send(client, {"id": None, "status": "error", "error": "bad job: not a JSON object"})
+                elif "steps" not in job or not (job.get("instructions") or job.get("instructions_base64")):
+                    await self.send(client, {"id": job.get("id"), "status": "error",
+                                             "error": "bad job: a job needs \"steps\" and the instructions"})
+                else:
+                    self.submit(client, job)
+        except ConnectionError:
+            pass
+        finally:
+            # Once the client hangs up its results have nowhere to go, so..
+            # ..whatever is still queued or running is dropped
+            if not client.closed:
+                client.closed = True
+                self.cancel(client)
+            writer.close()
+
+def parse_server_address(address):
+    # "unix:PATH" or anything with a slash is a Unix socket, otherwise..
+    # .."HOST:PORT" or just "PORT" on localhost
+    if address.startswith("unix:"):
+        return address[len("unix:"):], None
+    if "/" in address:
+        return address, None
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+async def serve(address, workers=None, translate=False, timeout=None):
+    host, port = parse_server_address(address)
+    server = SimulationServer(workers, translate, timeout)
+    server.start_workers()
+    executor = ThreadPoolExecutor(max_workers=server.num_workers)
+    forwarders = [asyncio.ensure_future(server.forward(i, executor)) for i in range(server.num_workers)]
+    try:
+        if port is None:
+            # Clear out a socket left behind by a server that was killed
+            if os.path.exists(host) and stat.S_ISSOCK(os.stat(host).st_mode):
+                os.unlink(host)
+            listener = await asyncio.start_unix_server(server.handle_client, path=host, limit=SERVER_LINE_LIMIT)
+        else:
+            listener = await asyncio.start_server(server.handle_client, host, port, limit=SERVER_LINE_LIMIT)
+        print(f"serving on {address} with {server.num_workers} workers", file=sys.stderr)
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.stop_workers()
+        for forwarder in forwarders:
+            forwarder.cancel()
+        executor.shutdown(wait=False)
+        if port is None and os.path.exists(host):
+            os.unlink(host)
+########## SIMULATION SERVER ##########
 
 ########## MAIN PROGRAM ##########
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Simulate a RISC-V binary and print the registers")
+    parser.add_argument("instructions_file", nargs="?")
+    parser.add_argument("operands", nargs="*", metavar="[data_file] num_instructions")
+    parser.add_argument("--translate", action="store_true",
+                        help="compile basic blocks into Python functions before running them")
+    parser.add_argument("--batch", metavar="MANIFEST",
+                        help="run every job in a JSON-lines manifest instead of a single program")
+    parser.add_argument("--output", default="results.jsonl",
+                        help="JSON-lines file the --batch results are written to")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="run jobs sent as JSON lines to a socket, HOST:PORT, PORT or a Unix socket path")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes for --batch and --serve (default: one per core)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds each --batch or --serve job may run before it is stopped")
+    parser.add_argument("--console-output", metavar="FILE",
+                        help="write what the program prints through the MMIO console to FILE")
+    parser.add_argument("--console-input", metavar="FILE",
+                        help="read the MMIO console input from FILE instead of stdin")
+    parser.add_argument("--decode-cache", metavar="DIR",
+                        help="keep decoded programs in DIR so later runs of the same binary skip decoding")
+    parser.add_argument("--decode-cache-size", type=int, default=DECODE_CACHE_SIZE >> 20, metavar="MB",
+                        help="size limit of the --decode-cache directory, least recently used entries go first")
+    parser.add_argument("--save-snapshot", metavar="FILE",
+                        help="save pc, registers and data memory to FILE when the run ends")
+    parser.add_argument("--resume", metavar="FILE",
+                        help="restore the machine state from a snapshot before running")
+    parser.add_argument("--profile", action="store_true",
+                        help="count executions per pc and mnemonic and print a hot-spot report on stderr")
+    parser.add_argument("--profile-time", action="store_true",
+                        help="with --profile, also sample wall time per instruction handler")
+    parser.add_argument("--profile-top", type=int, default=20,
+                        help="number of hot pcs in the --profile report")
+    parser.add_argument("--dcache", metavar="SPEC",
+                        help="simulate a data cache, e.g. size=32k,assoc=8,line=64,policy=lru,write=back,allocate=1,hit=1")
+    parser.add_argument("--icache", metavar="SPEC",
+                        help="simulate an instruction cache, same SPEC options as --dcache")
+    parser.add_argument("--l2", metavar="SPEC",
+                        help="shared second-level cache below --dcache/--icache")
+    parser.add_argument("--memory-latency", type=int, default=MEMORY_LATENCY,
+                        help="cycles for a main memory access in the AMAT figures")
+    parser.add_argument("--predictor", choices=sorted(PREDICTORS),
+                        help="check conditional branches against a branch predictor and report mispredictions")
+    parser.add_argument("--predictor-entries", type=int, default=PREDICTOR_ENTRIES,
+                        help="entries in the predictor table (a power of two)")
+    parser.add_argument("--btb", type=int, default=0, metavar="ENTRIES",
+                        help="also require a branch target buffer hit for taken predictions")
+    parser.add_argument("--branch-top", type=int, default=10,
+                        help="number of branch pcs in the --predictor report")
+    parser.add_argument("--timing", action="store_true",
+                        help="estimate cycles and CPI on a 5-stage pipeline and report them on stderr")
+    parser.add_argument("--fuse", action="store_true",
+                        help="run common instruction pairs as single fused steps and report the savings on stderr")
+    parser.add_argument("--fast-forward", type=int, default=0, metavar="N",
+                        help="run the first N of num_instructions on the fastest path, with no "
+                             "profiler, timing, caches, predictor or trace, then simulate the rest in detail")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record every retired instruction to FILE in a compact binary format")
+    parser.add_argument("--trace-compress", choices=TRACE_COMPRESSIONS,
+                        help="compress the --trace file")
+    parser.add_argument("--plugin", action="append", default=[], metavar="FILE",
+                        help="load instrumentation plugins from a Python file with a register(machine) function (repeatable)")
+    parser.add_argument("--read-trace", metavar="FILE",
+                        help="print a trace recorded with --trace instead of running a program")
+    parser.add_argument("--trace-range", metavar="START:END",
+                        help="with --read-trace, only print records with START <= pc < END")
+    parser.add_argument("--trace-limit", type=int, default=None,
+                        help="with --read-trace, stop after this many records")
+    parser.add_argument("--cache-size", type=int, default=DISASSEMBLY_CACHE_SIZE,
+                        help="entries in the disassembly LRU cache used by the listings (0 disables it)")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="report the disassembly cache hit rate on stderr after each listing")
+    args = parser.parse_args(argv)
+    for entries in (args.predictor_entries, args.btb):
+        if entries & (entries - 1) or entries < 0:
+            parser.error("--predictor-entries and --btb must be powers of two")
+    if args.predictor_entries < 1:
+        parser.error("--predictor-entries must be at least 1")
+    if args.l2 is not None and args.dcache is None and args.icache is None:
+        parser.error("--l2 needs --dcache or --icache above it")
+    for flag, name, spec in (("--dcache", "L1D", args.dcache), ("--icache", "L1I", args.icache), ("--l2", "L2", args.l2)):
+        if spec is not None:
+            # Build a throwaway cache so a bad geometry is a usage error,..
+            # ..not a traceback once the run starts
+            try:
+                parse_cache_spec(name, spec)
+            except ValueError as e:
+                parser.error(f"{flag}: {e}")
+    if args.timing and (args.profile or args.profile_time):
+        parser.error("--timing and --profile can't be used together")
+    if args.trace is not None and (args.timing or args.profile or args.profile_time):
+        parser.error("--trace can't be used with --timing or --profile")
+    if args.translate and (args.profile or args.profile_time or args.timing or args.trace or args.predictor
+                           or args.icache):
+        parser.error("--translate only applies to the plain interpreter, not with --profile, --timing, "
+                     "--trace, --predictor or --icache")
+    if args.fuse and (args.translate or args.profile or args.profile_time or args.timing or args.trace
+                      or args.predictor or args.icache):
+        parser.error("--fuse only applies to the plain interpreter, not with --translate, --profile, "
+                     "--timing, --trace, --predictor or --icache")
+    if args.fast_forward < 0:
+        parser.error("--fast-forward must not be negative")
+    if args.trace_compress == "zstd" and zstandard is None:
+        parser.error("--trace-compress zstd needs the zstandard module installed")
+    args.trace_start = args.trace_end = None
+    if args.trace_range is not None:
+        start, _, end = args.trace_range.partition(":")
+        try:
+            args.trace_start = int(start, 0) if start else None
+            args.trace_end = int(end, 0) if end else None
+        except ValueError:
+            parser.error("--trace-range expects START:END, e.g. 0x40:0x80")
+    if args.read_trace:
+        if args.instructions_file is not None:
+            parser.error("--read-trace doesn't run a program")
+        return args
+    if args.batch:
+        if args.instructions_file is not None:
+            parser.error("--batch takes its programs from the manifest")
+        return args
+    if args.serve:
+        if args.instructions_file is not None:
+            parser.error("--serve takes its programs from the clients")
+        try:
+            parse_server_address(args.serve)
+        except ValueError:
+            parser.error("--serve expects HOST:PORT, PORT or a Unix socket path")
+        return args
+    if args.instructions_file is None or len(args.operands) not in (1, 2):
+        parser.error("expected instructions_file [data_file] num_instructions")
+    args.data_file = args.operands[0] if len(args.operands) == 2 else None
+    args.num_instructions = int(args.operands[-1])
+    return args
+
 def main():
     # Read cmd arguments
-    instructions_file = sys.argv[1]
-    num_of_args = len(sys.argv)
-    if(num_of_args == 3):
-        num_instructions = int(sys.argv[2])
-    else:
-        data_file = sys.argv[2]
-        num_instructions = int(sys.argv[3])
-    
-    # Read the files
-    instructions_contents = read_file(instructions_file)
-    data_contents = b'' if num_of_args == 3 else read_file(data_file)
-
-    # Get the instructions and initialize registers + data memory
-    instructions = get_instructions(instructions_contents)
-    registers = [0x00000000] * 32
-    DATA_MEMORY_START = 0x10000000
-
-    data_memory = defaultdict(lambda: 0xFF)
-    for j in range(len(data_contents)):
-        data_memory[DATA_MEMORY_START + j] = data_contents[j]
-
-    # Execute each instructions
-    pc = 0
-    for _ in range(num_instructions):
-        if pc >= len(instructions) * 4:
-            break
-        inst = instructions[pc // 4]
-        pc = execute_instruction(inst, pc, registers, data_memory)
+    args = parse_args(sys.argv[1:])
+    if args.batch:
+        run_batch(args.batch, args.output, args.jobs, args.translate, args.timeout)
+        return
+    if args.serve:
+        try:
+            asyncio.run(serve(args.serve, args.jobs, args.translate, args.timeout))
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.read_trace:
+        print_trace(args.read_trace, args.trace_start, args.trace_end, args.trace_limit, args.cache_size, args.cache_stats)
+        return
+
+    # Read the data file (the instructions are mapped in below), a resumed..
+    # ..run takes its data memory from the snapshot instead
+    data_contents = b'' if args.data_file is None or args.resume is not None else read_file(args.data_file)
+
+    # Decode each instruction once on first use (or take the records from..
+    # ..the decode cache), then execute the records
+    with contextlib.ExitStack() as files:
+        console_output = None if args.console_output is None else files.enter_context(open(args.console_output, "w"))
+        console_input = None if args.console_input is None else files.enter_context(open(args.console_input))
+        instructions, decoded = load_program(args.instructions_file, args.decode_cache, args.decode_cache_size << 20)
+        machine = Machine(instructions, data_contents, Console(console_output, console_input), decoded)
+        if args.resume is not None:
+            machine.load_snapshot(args.resume)
+        # Fast-forward before any model is attached, they only see the..
+        # ..detailed region and its caches and predictor tables start cold
+        skipped = min(args.fast_forward, args.num_instructions)
+        if skipped:
+            try:
+                machine.fast_forward(skipped)
+            finally:
+                machine.console.flush()
+        if args.fuse:
+            machine.enable_fusion()
+        if args.profile or args.profile_time:
+            machine.profiler = Profiler(sample_time=args.profile_time)
+        if args.timing:
+            machine.attach_pipeline(PipelineModel())
+        if args.predictor is not None:
+            btb = BranchTargetBuffer(args.btb) if args.btb else None
+            machine.attach_branch_predictor(BranchUnit(PREDICTORS[args.predictor](args.predictor_entries), btb))
+        if args.dcache is not None or args.icache is not None:
+            latency = args.memory_latency
+            l2 = None if args.l2 is None else parse_cache_spec("L2", args.l2, None, latency)
+            dcache = None if args.dcache is None else parse_cache_spec("L1D", args.dcache, l2, latency)
+            icache = None if args.icache is None else parse_cache_spec("L1I", args.icache, l2, latency)
+            machine.attach_caches(dcache, icache)
+        if args.trace is not None:
+            machine.attach_trace(TraceWriter(args.trace, args.trace_compress))
+        for plugin_file in args.plugin:
+            load_plugin(plugin_file, machine)
+        if (args.translate or args.fuse) and any(getattr(plugin, name, None) is not None for plugin in machine.plugins
+                                                 for name in ("on_retire", "on_branch")):
+            mode = "--translate" if args.translate else "--fuse"
+            print(f"warning: a plugin has retire or branch hooks, {mode} is ignored and every step is interpreted",
+                  file=sys.stderr)
+        try:
+            machine.run(args.num_instructions - skipped, args.translate)
+        finally:
+            machine.console.flush()
+            if machine.trace is not None:
+                machine.trace.close()
+        if args.save_snapshot is not None:
+            machine.save_snapshot(args.save_snapshot)
 
-    for i, reg in enumerate(registers):
-        print(f"x{i}: {reg & 0xffffffff:#010x}")
+    for line in machine.register_dump():
+        print(line)
+    if machine.fused is not None:
+        sys.stdout.flush()
+        machine.fused.report()
+    if machine.profiler is not None:
+        sys.stdout.flush()
+        machine.profiler.report(machine.instructions, args.profile_top, args.cache_size, args.cache_stats)
+    if machine.pipeline is not None:
+        sys.stdout.flush()
+        machine.pipeline.report()
+    if machine.branch_unit is not None:
+        sys.stdout.flush()
+        machine.branch_unit.report(machine.instructions, args.branch_top, args.cache_size, args.cache_stats)
+    if machine.caches:
+        sys.stdout.flush()
+        for cache in machine.caches:
+            cache.report()
+    for plugin in machine.plugins:
+        report = getattr(plugin, "report", None)
+        if report is not None:
+            sys.stdout.flush()
+            report()
 
 if __name__ == "__main__":
     main()